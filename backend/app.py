@@ -14,12 +14,17 @@ from routes.annotation import annotation_router
 from routes.video import video_router
 from routes.inference import inference_router
 from routes.training import training_router
-from routes.util import init_models
+from routes.util import init_models, orjson, OrjsonJSONProvider
 from routes.generate_label import generate_label_router
 from routes.label import label_router
 
 # Initialize Flask App
 app = Flask(__name__)
+# Behind Apache/lighttpd, let the web server send files (see routes.util.send_data_file for nginx)
+app.use_x_sendfile = os.environ.get("USE_X_SENDFILE", "0") == "1"
+# Encode and decode API JSON with orjson when it is installed
+if orjson is not None:
+    app.json = OrjsonJSONProvider(app)
 CORS(app, resource={r"/api/*": {"origins": "*"}})
 
 init_models()
@@ -38,4 +43,4 @@ app.register_blueprint(label_router, url_prefix='/api/label')
 
 
 if __name__ == "__main__":
-    app.run(debug=False)
\ No newline at end of file
+    app.run(debug=False, threaded=True)
\ No newline at end of file
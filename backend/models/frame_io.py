@@ -0,0 +1,74 @@
+import os
+import cv2
+import numpy as np
+
+# libjpeg-turbo decodes JPEG frames noticeably faster than OpenCV's generic imread path.
+# It is optional: without PyTurboJPEG (or the native library) frames are read with OpenCV.
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJPF_RGB
+    _TJ = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _TJ = None
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+
+def is_jpeg(path):
+    return str(path).lower().endswith(JPEG_EXTENSIONS)
+
+
+def decode_frame(buf, rgb=False, jpeg=True):
+    """Decode encoded image bytes to a uint8 array in BGR (OpenCV) order, or RGB if rgb=True.
+    Returns None if the bytes cannot be decoded, like cv2.imread."""
+    if _TJ is not None and jpeg:
+        try:
+            return _TJ.decode(buf, pixel_format=TJPF_RGB if rgb else TJPF_BGR)
+        except (OSError, ValueError) as e:
+            print(f"TurboJPEG failed to decode frame, falling back to OpenCV: {e}")
+
+    frame = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if frame is not None and rgb:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    return frame
+
+
+def read_frame(path, rgb=False):
+    """Read an image file as a uint8 array in BGR (OpenCV) order, or RGB if rgb=True.
+    Returns None if the file cannot be read, like cv2.imread."""
+    try:
+        with open(path, 'rb') as f:
+            buf = f.read()
+    except OSError as e:
+        print(f"Error reading frame {path}: {e}")
+        return None
+    return decode_frame(buf, rgb=rgb, jpeg=is_jpeg(path))
+
+
+def encode_frame(frame, ext='.jpg', quality=95):
+    """Encode a BGR frame to image bytes (cv2.imwrite's default JPEG quality is 95).
+    Returns None if encoding fails."""
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if ext.lower() in JPEG_EXTENSIONS else []
+    ok, buf = cv2.imencode(ext, frame, params)
+    return buf.tobytes() if ok else None
+
+
+def write_bytes(path, data):
+    """Write data to path with raw os.write calls, bypassing Python's file buffering"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def write_many(items):
+    """Write a batch of (path, data) pairs in one task, returning [(path, error)] for failures"""
+    failed = []
+    for path, data in items:
+        try:
+            write_bytes(path, data)
+        except OSError as e:
+            failed.append((path, e))
+    return failed
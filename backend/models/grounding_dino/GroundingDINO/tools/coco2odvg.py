@@ -1,4 +1,3 @@
-import jsonlines
 from tqdm import tqdm
 import json
 from pycocotools.coco import COCO
@@ -8,16 +7,19 @@ from pycocotools.coco import COCO
 # {"0": "person", "1": "bicycle", "2": "car", "3": "motorcycle", "4": "airplane", "5": "bus", "6": "train", "7": "truck", "8": "boat", "9": "traffic light", "10": "fire hydrant", "11": "stop sign", "12": "parking meter", "13": "bench", "14": "bird", "15": "cat", "16": "dog", "17": "horse", "18": "sheep", "19": "cow", "20": "elephant", "21": "bear", "22": "zebra", "23": "giraffe", "24": "backpack", "25": "umbrella", "26": "handbag", "27": "tie", "28": "suitcase", "29": "frisbee", "30": "skis", "31": "snowboard", "32": "sports ball", "33": "kite", "34": "baseball bat", "35": "baseball glove", "36": "skateboard", "37": "surfboard", "38": "tennis racket", "39": "bottle", "40": "wine glass", "41": "cup", "42": "fork", "43": "knife", "44": "spoon", "45": "bowl", "46": "banana", "47": "apple", "48": "sandwich", "49": "orange", "50": "broccoli", "51": "carrot", "52": "hot dog", "53": "pizza", "54": "donut", "55": "cake", "56": "chair", "57": "couch", "58": "potted plant", "59": "bed", "60": "dining table", "61": "toilet", "62": "tv", "63": "laptop", "64": "mouse", "65": "remote", "66": "keyboard", "67": "cell phone", "68": "microwave", "69": "oven", "70": "toaster", "71": "sink", "72": "refrigerator", "73": "book", "74": "clock", "75": "vase", "76": "scissors", "77": "teddy bear", "78": "hair drier", "79": "toothbrush"}
 
 id_map = {0: 1, 1: 2, 2: 3, 3: 4}
-key_list=list(id_map.keys())
-val_list=list(id_map.values())
 
-def dump_label_map(output="./out.json"):
-    ori_map = {'0': 'White Shirt Blue Shorts', '1': 'Pink Shirt', '2': 'White Shirt Green Shorts', '3': 'Green Shirt'}
+# ori_map used by dump_label_map when none is given
+ori_map = {'0': 'White Shirt Blue Shorts', '1': 'Pink Shirt', '2': 'White Shirt Green Shorts', '3': 'Green Shirt'}
+
+def _label_lookup(id_map):
+    """Map category id -> training label (the inverse of id_map)"""
+    return {cat_id: label for label, cat_id in id_map.items()}
+
+def dump_label_map(output="./out.json", ori_map=ori_map, id_map=id_map):
+    label_of = _label_lookup(id_map)
     new_map = {}
     for key, value in ori_map.items():
-        label = int(key)
-        ind=val_list.index(label)
-        label_trans = key_list[ind]
+        label_trans = label_of[int(key)]
         new_map[label_trans] = value
     with open(output,"w") as f:
         json.dump(new_map, f)
@@ -31,32 +33,26 @@ def coco_to_xyxy(bbox):
     return [x1, y1, x2, y2]
 
 
-def coco2odvg(input, output):
-    coco = COCO(input) 
-    cats = coco.loadCats(coco.getCatIds())
-    print("CAT IDS are", cats)    
-    nms = {cat['id']:cat['name'] for cat in cats}
-    metas = []
+def coco2odvg_from_objs(images, annotations, categories, output, id_map=id_map):
+    """Write ODVG jsonlines from already-loaded COCO lists, one image per line"""
+    label_of = _label_lookup(id_map)
+    nms = {cat['id']: cat['name'] for cat in categories}
+    anns_by_image = {}
+    for ann in annotations:
+        anns_by_image.setdefault(ann['image_id'], []).append(ann)
 
-    for img_id, img_info in tqdm(coco.imgs.items()):
-        ann_ids = coco.getAnnIds(imgIds=img_id)
-        instance_list = []
-        for ann_id in ann_ids:
-            ann = coco.anns[ann_id]
-            bbox = ann['bbox']
-            bbox_xyxy = coco_to_xyxy(bbox)
-            label = ann['category_id']
-            category = nms[label]
-            ind=val_list.index(label)
-            label_trans = key_list[ind]
-            instance_list.append({
-                "bbox": bbox_xyxy,
-                "label": label_trans,
-                "category": category
-                }
-            )
-        metas.append(
-            {
+    with open(output, "w", encoding="utf-8") as f:
+        for img_info in tqdm(images):
+            instance_list = []
+            for ann in anns_by_image.get(img_info['id'], ()):
+                label = ann['category_id']
+                instance_list.append({
+                    "bbox": coco_to_xyxy(ann['bbox']),
+                    "label": label_of[label],
+                    "category": nms[label]
+                    }
+                )
+            meta = {
                 "filename": img_info["file_name"],
                 "height": img_info["height"],
                 "width": img_info["width"],
@@ -64,8 +60,15 @@ def coco2odvg(input, output):
                     "instances": instance_list
                 }
             }
-        )
+            f.write(json.dumps(meta, ensure_ascii=False))
+            f.write("\n")
+
+
+def coco2odvg(input, output, id_map=id_map):
+    """Convert a COCO file to ODVG jsonlines; id_map maps training label -> COCO category id"""
+    coco = COCO(input) 
+    cats = coco.loadCats(coco.getCatIds())
+    print("CAT IDS are", cats)    
     print("  == dump meta ...")
-    with jsonlines.open(output, mode="w") as writer:
-        writer.write_all(metas)
+    coco2odvg_from_objs(list(coco.imgs.values()), coco.dataset.get('annotations', []), cats, output, id_map=id_map)
     print("  == done.")
@@ -0,0 +1,463 @@
+import os
+import glob
+import json
+import argparse
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import torch
+import torch.nn.functional as F
+from torch import nn
+from PIL import Image
+from tqdm import tqdm
+import groundingdino.datasets.transforms as T
+from groundingdino.util.misc import nested_tensor_from_tensor_list
+from groundingdino.util.utils import get_phrases_from_posmap
+
+from models.frame_io import read_frame, decode_frame, is_jpeg
+
+from models.grounding_dino.GroundingDINO.inference_on_a_folder import (
+    load_model,
+    convert_boxes_to_json,
+    plot_boxes_to_image,
+)
+
+BBOX_DIR = os.path.join("data", "bbox")
+VALID_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+
+# Number of frames stacked into one forward pass
+BATCH_SIZE = int(os.environ.get("GROUNDING_DINO_BATCH_SIZE", 8))
+
+# Decode -> infer -> write pipeline sizing
+DECODE_WORKERS = 4
+WRITE_WORKERS = 4
+QUEUE_SIZE = 32
+BATCH_TIMEOUT = 0.05  # seconds to wait for more decoded frames before running a partial batch
+
+IMAGE_MEAN = [0.485, 0.456, 0.406]
+IMAGE_STD = [0.229, 0.224, 0.225]
+RESIZE_SIZE = 800
+RESIZE_MAX_SIZE = 1333
+
+TRANSFORM = T.Compose(
+    [
+        T.RandomResize([RESIZE_SIZE], max_size=RESIZE_MAX_SIZE),
+        T.ToTensor(),
+        T.Normalize(IMAGE_MEAN, IMAGE_STD),
+    ]
+)
+
+# Decode JPEG frames with nvJPEG straight into GPU memory when CUDA is available
+GPU_DECODE = os.environ.get("GROUNDING_DINO_GPU_DECODE", "1") == "1"
+
+_DONE = object()
+
+# Distinct captions/batch sizes whose text features are kept per model
+TEXT_CACHE_SIZE = 8
+
+
+def load_frame(image_path):
+    """Decode a frame (libjpeg-turbo or OpenCV, both release the GIL) and apply the model transform"""
+    frame = read_frame(image_path, rgb=True)
+    if frame is None:
+        raise ValueError(f"Could not read image {image_path}")
+    image_pil = Image.fromarray(frame)
+    image, _ = TRANSFORM(image_pil, None)  # 3, h, w
+    return image_pil, image
+
+
+def load_frame_bytes(image_path):
+    """Read the encoded JPEG for GPU decoding; other formats are decoded on the CPU"""
+    if not is_jpeg(image_path):
+        return load_frame(image_path)
+    with open(image_path, 'rb') as f:
+        return f.read()
+
+
+def _resized_shape(h, w, size=RESIZE_SIZE, max_size=RESIZE_MAX_SIZE):
+    """Output (h, w) of T.RandomResize([size], max_size) for an h x w image"""
+    min_original_size = float(min(w, h))
+    max_original_size = float(max(w, h))
+    if max_original_size / min_original_size * size > max_size:
+        size = int(round(max_size * min_original_size / max_original_size))
+    if (w <= h and w == size) or (h <= w and h == size):
+        return h, w
+    if w < h:
+        return int(size * h / w), size
+    return size, int(size * w / h)
+
+
+def save_prediction(image_pil, boxes_filt, pred_phrases, save_path):
+    pred_dict = {
+        "boxes": boxes_filt,
+        "size": [image_pil.size[1], image_pil.size[0]],  # H,W
+        "labels": pred_phrases,
+    }
+    image_with_box = plot_boxes_to_image(image_pil, pred_dict)[0]
+    image_with_box.save(save_path)
+
+
+def _normalize_caption(caption):
+    caption = caption.lower().strip()
+    if not caption.endswith("."):
+        caption = caption + "."
+    return caption
+
+
+class CachedTokenizer:
+    """Tokenizer wrapper that returns the same encoding for repeated calls.
+
+    Every frame of a folder uses the same caption, so the encoding only has to be built
+    once; GroundingDINO's forward moves it to the device in place, so later batches
+    reuse the device tensors too."""
+
+    def __init__(self, tokenizer, maxsize=TEXT_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.maxsize = maxsize
+        self._cache = {}
+
+    def __call__(self, text, **kwargs):
+        key = (tuple(text) if isinstance(text, list) else text, tuple(sorted(kwargs.items())))
+        encoded = self._cache.get(key)
+        if encoded is None:
+            if len(self._cache) >= self.maxsize:
+                self._cache.pop(next(iter(self._cache)))
+            encoded = self._cache[key] = self.tokenizer(text, **kwargs)
+        return encoded
+
+    def __getattr__(self, name):
+        return getattr(self.tokenizer, name)
+
+
+class CachedTextEncoder(nn.Module):
+    """Reuses the BERT output when the forward is given the same cached input_ids tensor,
+    so the text tower runs once per caption instead of once per batch."""
+
+    def __init__(self, bert, maxsize=TEXT_CACHE_SIZE):
+        super().__init__()
+        self.bert = bert
+        self.config = bert.config
+        self.maxsize = maxsize
+        self._cache = []  # (input_ids, output), newest last
+
+    def forward(self, input_ids=None, **kwargs):
+        for cached_ids, output in self._cache:
+            if cached_ids is input_ids:
+                return output
+        output = self.bert(input_ids=input_ids, **kwargs)
+        if input_ids is not None and not torch.is_grad_enabled():
+            self._cache = self._cache[-(self.maxsize - 1):] + [(input_ids, output)]
+        return output
+
+
+class Inferencer:
+    """Keeps a GroundingDINO model loaded so frame folders can be processed in-process."""
+
+    def __init__(self, cfg, ckpt, box_threshold=0.3, text_threshold=0.25, cpu_only=False,
+                 batch_size=BATCH_SIZE):
+        self.config_file = cfg
+        self.checkpoint_path = ckpt
+        self.box_threshold = box_threshold
+        self.text_threshold = text_threshold
+        self.cpu_only = cpu_only
+        self.batch_size = max(1, batch_size)
+        self.device = "cuda" if not cpu_only else "cpu"
+        self.model = load_model(cfg, ckpt, cpu_only=cpu_only).to(self.device)
+        # The caption is fixed for a folder: tokenize it and run the text encoder once
+        self.model.tokenizer = CachedTokenizer(self.model.tokenizer)
+        self.model.bert = CachedTextEncoder(self.model.bert)
+        self.gpu_decode = GPU_DECODE and not cpu_only and torch.cuda.is_available()
+        if self.gpu_decode:
+            self.mean = torch.tensor(IMAGE_MEAN, device=self.device).view(3, 1, 1)
+            self.std = torch.tensor(IMAGE_STD, device=self.device).view(3, 1, 1)
+        # Separate streams let batch N+1's upload and batch N-1's download overlap batch N's compute
+        use_streams = not cpu_only and torch.cuda.is_available()
+        self.copy_stream = torch.cuda.Stream() if use_streams else None
+        self.d2h_stream = torch.cuda.Stream() if use_streams else None
+        # A single model instance must not run two folders at once
+        self.lock = threading.Lock()
+
+    def list_frames(self, frames_dir):
+        image_files = []
+        for ext in VALID_EXTENSIONS:
+            image_files.extend(glob.glob(os.path.join(frames_dir, f"*{ext}")))
+        return sorted(image_files)
+
+    def decode_on_device(self, buffers):
+        """Decode JPEG bytes with nvJPEG and resize/normalize on the GPU, matching TRANSFORM.
+        Returns the model input tensors and each frame's original (W, H)."""
+        from torchvision.io import decode_jpeg, ImageReadMode
+
+        data = [torch.frombuffer(bytearray(buf), dtype=torch.uint8) for buf in buffers]
+        decoded = decode_jpeg(data, mode=ImageReadMode.RGB, device=self.device)
+        images, sizes = [], []
+        for frame in decoded:
+            h, w = frame.shape[-2:]
+            image = frame.float().div_(255).unsqueeze(0)
+            image = F.interpolate(image, size=_resized_shape(h, w), mode="bilinear",
+                                  align_corners=False, antialias=True)[0]
+            images.append(image.sub_(self.mean).div_(self.std))
+            sizes.append((w, h))
+        return images, sizes
+
+    def _load_batch(self, batch):
+        """Resolve decoded frames into (image_path, source, image tensor, (W, H)) tuples.
+        source is a PIL image, or the JPEG bytes when the frame was decoded on the GPU."""
+        loaded, encoded = [], []
+        for image_path, future in batch:
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error processing {image_path}: {str(e)}")
+                continue
+            if isinstance(result, bytes):
+                encoded.append((image_path, result))
+            else:
+                image_pil, image = result
+                loaded.append((image_path, image_pil, image, image_pil.size))
+
+        if encoded:
+            try:
+                images, sizes = self.decode_on_device([buf for _, buf in encoded])
+                loaded.extend((image_path, buf, image, size)
+                              for (image_path, buf), image, size in zip(encoded, images, sizes))
+            except Exception as e:
+                print(f"GPU decode failed, falling back to CPU decoding: {str(e)}")
+                self.gpu_decode = False
+                for image_path, buf in encoded:
+                    frame = decode_frame(buf, rgb=True)
+                    if frame is None:
+                        print(f"Error processing {image_path}: could not decode image")
+                        continue
+                    image_pil = Image.fromarray(frame)
+                    image, _ = TRANSFORM(image_pil, None)
+                    loaded.append((image_path, image_pil, image, image_pil.size))
+        return loaded
+
+    def _upload(self, images):
+        """Start copying a batch to the GPU on the copy stream so it overlaps the previous batch's compute.
+        Returns the device tensors and an event the compute stream waits on."""
+        if self.copy_stream is None:
+            return [image.to(self.device) for image in images], None
+        # Taken before switching streams: inside the context current_stream() is the copy stream
+        compute_stream = torch.cuda.current_stream(self.device)
+        with torch.cuda.stream(self.copy_stream):
+            uploaded = []
+            for image in images:
+                if image.is_cuda:
+                    uploaded.append(image)
+                    continue
+                image = image.pin_memory().to(self.device, non_blocking=True)
+                # The tensor is allocated on the copy stream but consumed on the compute stream
+                image.record_stream(compute_stream)
+                uploaded.append(image)
+            ready = torch.cuda.Event()
+            ready.record(self.copy_stream)
+        return uploaded, ready
+
+    def _launch(self, images, ready, caption):
+        """Queue the forward pass behind the upload and start copying the outputs back on the D2H stream"""
+        caption = _normalize_caption(caption)
+        if ready is not None:
+            torch.cuda.current_stream(self.device).wait_event(ready)
+        with torch.inference_mode():
+            # Pad to a NestedTensor here: the forward reads samples.device before it would
+            # convert a plain list itself
+            samples = nested_tensor_from_tensor_list(images)
+            outputs = self.model(samples, captions=[caption] * len(images))
+            logits = outputs["pred_logits"].sigmoid()  # (bs, nq, 256)
+            boxes = outputs["pred_boxes"]  # (bs, nq, 4)
+        if self.d2h_stream is None:
+            return logits.cpu(), boxes.cpu(), None
+
+        self.d2h_stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.d2h_stream):
+            logits.record_stream(self.d2h_stream)
+            boxes.record_stream(self.d2h_stream)
+            logits = logits.to("cpu", non_blocking=True)
+            boxes = boxes.to("cpu", non_blocking=True)
+            done = torch.cuda.Event()
+            done.record(self.d2h_stream)
+        return logits, boxes, done
+
+    def _finish(self, launched, caption):
+        """Wait for a launched batch's outputs and filter them.
+        Returns (boxes_filt, pred_phrases, confidence_scores) per image."""
+        logits, boxes, done = launched
+        if done is not None:
+            done.synchronize()
+        caption = _normalize_caption(caption)
+        tokenizer = self.model.tokenizer
+        tokenized = tokenizer(caption)
+        results = []
+        for logits_i, boxes_i in zip(logits, boxes):
+            filt_mask = logits_i.max(dim=1)[0] > self.box_threshold
+            logits_filt = logits_i[filt_mask]  # num_filt, 256
+            boxes_filt = boxes_i[filt_mask]  # num_filt, 4
+
+            pred_phrases = []
+            confidence_scores = []
+            for logit in logits_filt:
+                pred_phrase = get_phrases_from_posmap(logit > self.text_threshold, tokenized, tokenizer)
+                confidence_scores.append(float(logit.max().item()))
+                pred_phrases.append(pred_phrase + f"({str(logit.max().item())[:4]})")
+            results.append((boxes_filt, pred_phrases, confidence_scores))
+        return results
+
+    def _feed_decoder(self, image_files, decoder, decode_q):
+        """Submit decode jobs in frame order; the bounded queue limits frames in flight"""
+        for image_path in image_files:
+            load = load_frame_bytes if self.gpu_decode else load_frame
+            decode_q.put((image_path, decoder.submit(load, image_path)))
+        decode_q.put(_DONE)
+
+    def _next_batch(self, decode_q):
+        """Collect up to batch_size decoded frames, running a partial batch if decoding falls behind"""
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                item = decode_q.get(timeout=BATCH_TIMEOUT) if batch else decode_q.get()
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _write_worker(self, write_q):
+        while True:
+            item = write_q.get()
+            if item is _DONE:
+                return
+            image_path, source, boxes_filt, pred_phrases, save_path = item
+            try:
+                # Frames decoded on the GPU are re-decoded here, off the inference thread
+                image_pil = source if isinstance(source, Image.Image) else Image.fromarray(decode_frame(source, rgb=True))
+                save_prediction(image_pil, boxes_filt, pred_phrases, save_path)
+            except Exception as e:
+                print(f"Error saving prediction for {image_path}: {str(e)}")
+
+    def predict_folder(self, frames_dir, labels, out_dir):
+        """Run detection on every frame in frames_dir, saving annotated frames to out_dir
+        and the detections to data/bbox/<video>_boxes.json.
+
+        Decoding, GPU inference and writing run as a pipeline: a thread pool decodes frames
+        ahead of the model, and writer threads save annotated frames behind it."""
+        print(f"Processing images in folder: {frames_dir}")
+        video_name = os.path.basename(os.path.normpath(frames_dir))
+        os.makedirs(BBOX_DIR, exist_ok=True)
+        os.makedirs(out_dir, exist_ok=True)
+
+        image_files = self.list_frames(frames_dir)
+        all_detections = {}
+
+        decode_q = queue.Queue(maxsize=QUEUE_SIZE)
+        write_q = queue.Queue(maxsize=QUEUE_SIZE)
+
+        with self.lock, ThreadPoolExecutor(max_workers=DECODE_WORKERS) as decoder, \
+                tqdm(total=len(image_files), desc="Processing images") as progress:
+            # One OpenCV thread per decode worker avoids oversubscribing the CPU. The setting
+            # is process-wide and the inferencer lives in the server, so it is restored below.
+            cv_threads = cv2.getNumThreads()
+            cv2.setNumThreads(1)
+
+            feeder = threading.Thread(target=self._feed_decoder, args=(image_files, decoder, decode_q), daemon=True)
+            writers = [threading.Thread(target=self._write_worker, args=(write_q,), daemon=True)
+                       for _ in range(WRITE_WORKERS)]
+            feeder.start()
+            for writer in writers:
+                writer.start()
+
+            def emit(batch_start, loaded, launched):
+                try:
+                    results = self._finish(launched, labels)
+                except Exception as e:
+                    print(f"Error processing batch starting at {batch_start}: {str(e)}")
+                    return
+                for (image_path, source, _, size), (boxes_filt, pred_phrases, confidence_scores) in zip(loaded, results):
+                    base_name = os.path.splitext(os.path.basename(image_path))[0]
+                    all_detections[base_name] = convert_boxes_to_json(
+                        boxes_filt, pred_phrases, confidence_scores, size
+                    )
+                    save_path = os.path.join(out_dir, f"{base_name}_pred.jpg")
+                    write_q.put((image_path, source, boxes_filt, pred_phrases, save_path))
+
+            try:
+                # Batch N is launched before batch N-1's results are collected, so the GPU
+                # is never idle while the CPU filters detections and queues writes
+                pending = None
+                done = False
+                while not done:
+                    batch, done = self._next_batch(decode_q)
+                    if not batch:
+                        continue
+
+                    loaded = self._load_batch(batch)
+                    launched = None
+                    if loaded:
+                        try:
+                            uploaded, ready = self._upload([image for _, _, image, _ in loaded])
+                            launched = (batch[0][0], loaded, self._launch(uploaded, ready, labels))
+                        except Exception as e:
+                            print(f"Error processing batch starting at {batch[0][0]}: {str(e)}")
+
+                    if pending is not None:
+                        emit(*pending)
+                    pending = launched
+                    progress.update(len(batch))
+
+                if pending is not None:
+                    emit(*pending)
+                if self.copy_stream is not None:
+                    torch.cuda.synchronize()
+            finally:
+                for _ in writers:
+                    write_q.put(_DONE)
+                for writer in writers:
+                    writer.join()
+                # Unblock the feeder if inference stopped before the queue was drained
+                while feeder.is_alive():
+                    try:
+                        decode_q.get(timeout=BATCH_TIMEOUT)
+                    except queue.Empty:
+                        pass
+                cv2.setNumThreads(cv_threads)
+
+        json_path = os.path.join(BBOX_DIR, f"{video_name}_boxes.json")
+        with open(json_path, 'w') as f:
+            json.dump(all_detections, f, indent=4)
+
+        print(f"Saved bbox coordinates to {json_path}")
+        return json_path
+
+
+def write_manifest(path, frames_dir, predictions_dir, model_path, labels, config_path):
+    """Describe one inference job as a small JSON file for `python -m ... --manifest`"""
+    manifest = {
+        "frames_dir": frames_dir,
+        "predictions_dir": predictions_dir,
+        "model_path": model_path,
+        "labels": labels,
+        "config_path": config_path,
+    }
+    with open(path, 'w') as f:
+        json.dump(manifest, f)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run GroundingDINO over a folder of frames")
+    parser.add_argument("--manifest", required=True, help="JSON job description written by write_manifest")
+    parser.add_argument("--cpu-only", action="store_true")
+    args = parser.parse_args()
+
+    with open(args.manifest, 'r') as f:
+        manifest = json.load(f)
+
+    inferencer = Inferencer(manifest["config_path"], manifest["model_path"], cpu_only=args.cpu_only)
+    inferencer.predict_folder(manifest["frames_dir"], manifest["labels"], manifest["predictions_dir"])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,94 @@
 import cv2
 import json
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 import numpy as np
 from ultralytics import YOLO
+try:
+    import ijson
+except ImportError:
+    ijson = None
+from models.frame_io import read_frame, encode_frame, write_many
+
+# Frames rendered concurrently by process_frames, each thread with its own YOLO instance
+POSE_WORKERS = int(os.environ.get("POSE_WORKERS", min(4, os.cpu_count() or 1)))
+# Threads writing encoded frames to disk behind the pose workers
+WRITE_WORKERS = 4
+# Encoded frames handed to a writer per task
+WRITE_BATCH_SIZE = 32
+
+# Idle YOLO instances per weights file, shared by every analyzer. YOLO models are not safe to
+# share between threads, so each thread borrows one; at most POSE_WORKERS are kept per file.
+_MODEL_POOLS = {}
+_MODEL_POOLS_LOCK = threading.Lock()
+
+@contextmanager
+def borrow_model(model_path):
+    """Lend a YOLO model no other thread is using, building one if the pool is empty"""
+    with _MODEL_POOLS_LOCK:
+        pool = _MODEL_POOLS.setdefault(model_path, queue.Queue(maxsize=POSE_WORKERS))
+    try:
+        model = pool.get_nowait()
+    except queue.Empty:
+        model = YOLO(model_path)
+    try:
+        yield model
+    finally:
+        try:
+            pool.put_nowait(model)
+        except queue.Full:
+            pass  # More threads than workers were posing at once; drop the extra instance
 
 class TennisPlayerAnalyzer:
     def __init__(self, frames_dir, bbox_file, yolo_model_path="models/pose_estimation/yolo11x-pose.pt"):
         self.frames_dir = Path(frames_dir)
         self.bbox_file = Path(bbox_file)
+        self._bbox_stamp = None
         self.predictions = self.load_predictions()
-        self.model = YOLO(yolo_model_path)
+        self.yolo_model_path = yolo_model_path
+        # Load the weights up front so the first request doesn't pay for it
+        with borrow_model(yolo_model_path):
+            pass
         self.scale_factor = 1.8
+        # Shared analyzers are used from several request threads
+        self.lock = threading.Lock()
 
     def load_predictions(self):
         try:
-            with open(self.bbox_file, 'r') as f:
-                bbox_data = json.load(f)
+            stat = os.stat(self.bbox_file)
+            with open(self.bbox_file, 'rb') as f:
+                # Stream frame by frame instead of building the whole parse tree at once
+                if ijson is not None:
+                    bbox_data = dict(ijson.kvitems(f, '', use_float=True))
+                else:
+                    bbox_data = json.load(f)
 
+            self._bbox_stamp = (stat.st_mtime_ns, stat.st_size)
             return bbox_data
         except Exception as e:
             print(f"Error loading predictions: {str(e)}")
             return {}
 
+    def reload_boxes(self, bbox_file):
+        """Re-read the bbox JSON if it changed, keeping the pose model loaded"""
+        bbox_file = Path(bbox_file)
+        try:
+            stat = os.stat(bbox_file)
+        except OSError:
+            stat = None
+
+        stamp = (stat.st_mtime_ns, stat.st_size) if stat else None
+        if bbox_file == self.bbox_file and stamp is not None and stamp == self._bbox_stamp:
+            return self.predictions
+
+        self.bbox_file = bbox_file
+        self.predictions = self.load_predictions()
+        return self.predictions
+
     def expand_bbox(self, bbox):
         x1, y1, x2, y2 = bbox
 
@@ -139,11 +205,14 @@ class TennisPlayerAnalyzer:
 
                 cv2.circle(frame, (int(x), int(y)), 4, color, -1)
 
-    def process_frame(self, frame_path, all_poses):
+    def process_frame(self, frame_path, all_poses, model=None):
         """Process a single frame with multiple bounding boxes"""
+        if model is None:
+            with borrow_model(self.yolo_model_path) as model:
+                return self.process_frame(frame_path, all_poses, model)
         frame_number = frame_path.stem.split('/')[-1]
         frame_number = frame_number.split('.')[0]
-        frame = cv2.imread(str(frame_path))
+        frame = read_frame(frame_path)
 
         if frame is None:
             print(f"Error reading frame {frame_path}")
@@ -215,7 +284,7 @@ class TennisPlayerAnalyzer:
                     continue
 
                 # Get pose keypoints and confidence
-                pose_results = self.model(player_crop)
+                pose_results = model(player_crop)
                 crop_keypoints, keypoint_conf = self.process_pose_keypoints(pose_results)
 
                 # Map keypoints back to original frame coordinates
@@ -266,12 +335,28 @@ class TennisPlayerAnalyzer:
         processed_frames = []
         all_poses = {}
 
-        for frame_path in frame_files:
-            frame_with_poses, frame_number, all_poses = self.process_frame(frame_path, all_poses)
-            # Save processed frame
-            output_path = output_dir / f"{frame_number}_pred.jpg"
-            cv2.imwrite(str(output_path), frame_with_poses)
-            processed_frames.append(output_path)
+        # Frames are independent, so render them on a thread pool; map() keeps frame order
+        # so the poses file is written in the same order as before
+        # Encoded frames are handed to a writer pool in batches so pose workers don't wait on disk
+        writes = []
+        pending = []
+        with ThreadPoolExecutor(max_workers=POSE_WORKERS) as pool, \
+                ThreadPoolExecutor(max_workers=WRITE_WORKERS) as writer:
+            for output_path, frame_poses, encoded in pool.map(lambda path: self._render_frame(path, output_dir), frame_files):
+                all_poses.update(frame_poses)
+                if output_path is None:
+                    continue
+                pending.append((output_path, encoded))
+                processed_frames.append(output_path)
+                if len(pending) >= WRITE_BATCH_SIZE:
+                    writes.append(writer.submit(write_many, pending))
+                    pending = []
+            if pending:
+                writes.append(writer.submit(write_many, pending))
+
+        for write in writes:
+            for output_path, error in write.result():
+                print(f"Error saving frame {output_path}: {error}")
 
         # Save complete poses file in data/pose directory
         pose_dir = Path("data") / "pose_coordinates"
@@ -283,6 +368,21 @@ class TennisPlayerAnalyzer:
 
         return processed_frames
 
+    def _render_frame(self, frame_path, output_dir):
+        """Pose one frame and encode the rendered image, using a model no other thread holds"""
+        frame_poses = {}
+        with borrow_model(self.yolo_model_path) as model:
+            frame_with_poses, frame_number, _ = self.process_frame(frame_path, frame_poses, model)
+
+        if frame_with_poses is None:
+            return None, frame_poses, None
+        # cv2.imencode releases the GIL, so frames encode in parallel across workers
+        encoded = encode_frame(frame_with_poses)
+        if encoded is None:
+            print(f"Error encoding frame {frame_path}")
+            return None, frame_poses, None
+        return output_dir / f"{frame_number}_pred.jpg", frame_poses, encoded
+
     def create_video(self, processed_frames, output_path, fps=30):
         if not processed_frames:
             print("No processed frames available to create video")
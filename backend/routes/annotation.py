@@ -1,10 +1,11 @@
 import json
 import os
 import cv2
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, current_app, request, jsonify
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from routes.util import split_dataset
+from routes.util import split_dataset, load_json, cached_by_stat
 from models.pose_estimation.tennis_analyzer import TennisPlayerAnalyzer
 
 annotation_router = Blueprint("annotation", __name__)
@@ -32,6 +33,20 @@ def get_rallies_path(video_id):
     """Get path for video's prediction file"""
     return os.path.join(RALLIES_DIR, f"{video_id}_rallies.json")
 
+def get_boxes_path(video_id):
+    """Get path for video's bounding box file"""
+    return os.path.join(DATA_DIR, "bbox", f"{video_id}_boxes.json")
+
+@lru_cache(maxsize=4)
+def _load_pose_analyzer(video_id):
+    """Build the pose analyzer for a video once so the YOLO weights stay resident"""
+    return TennisPlayerAnalyzer(os.path.join(RAW_FRAMES_DIR, video_id), get_boxes_path(video_id))
+
+def get_pose_analyzer(video_id):
+    """Get the shared pose analyzer for a video.
+    Callers should hold analyzer.lock and call reload_boxes() before processing."""
+    return _load_pose_analyzer(video_id)
+
 def parse_image_url(image_url):
     """Get video ID from image URL"""
     data = image_url.split("/")
@@ -120,17 +135,22 @@ def save_annotation_coco(video_id, image_url, bounding_boxes, width, height):
         print(f"Error saving COCO annotations: {e}")
         raise
 
+@cached_by_stat(maxsize=16)
+def _annotations_body(annotation_file):
+    return current_app.json.dumps(load_json(annotation_file))
+
 @annotation_router.route("/get/<video_id>", methods=["GET"])
 def get_annotations_rest(video_id):
-    """Get annotations for specific video"""
+    """Get annotations for specific video. The serialized body is reused until the
+    annotation file is written again."""
     annotation_file = get_annotation_path(video_id)
-    if not os.path.exists(annotation_file):
+    try:
+        body = _annotations_body(annotation_file)
+    except FileNotFoundError:
         print("Annotations not found")
         return jsonify({"error": "Annotations not found"}), 404
-    
-    with open(annotation_file) as f:
-        annotations = json.load(f)    
-    return jsonify(annotations)
+
+    return current_app.response_class(body, mimetype="application/json")
 
 @annotation_router.route("/get-bbox", methods=['POST'])
 def get_bounding_boxes():
@@ -164,8 +184,7 @@ def update_annotations_rest():
         return jsonify({"error": "Missing required fields"}), 400    
 
     # Get frame_path and json_file
-    raw_frames_path = os.path.join(RAW_FRAMES_DIR, video_id)
-    boxes_path = os.path.join(DATA_DIR, "bbox", f"{video_id}_boxes.json")
+    boxes_path = get_boxes_path(video_id)
     frame_path = Path(os.path.join(RAW_FRAMES_DIR, video_id, f"{frame_number}.jpg"))
     pose_coordinates_path = os.path.join(POSE_COORDINATES_DIR, f"{video_id}_pose.json")    
     output_dir = os.path.join(POSE_FRAMES_DIR, video_id)
@@ -186,10 +205,12 @@ def update_annotations_rest():
     # Update poses json
     with open(boxes_path, 'w') as f:
         json.dump(new_boxes, f, indent=2)
-    analyzer = TennisPlayerAnalyzer(raw_frames_path, boxes_path)    
+    analyzer = get_pose_analyzer(video_id)
     with open(pose_coordinates_path, 'r') as pose_coordinates_json:
         all_poses = json.load(pose_coordinates_json)
-    frame_with_poses, _, all_poses = analyzer.process_frame(frame_path, all_poses)        
+    with analyzer.lock:
+        analyzer.reload_boxes(boxes_path)
+        frame_with_poses, _, all_poses = analyzer.process_frame(frame_path, all_poses)
 
     output_path = os.path.join(output_dir, f"{frame_number}_pred.jpg")
     cv2.imwrite(str(output_path), frame_with_poses)
@@ -292,6 +313,37 @@ def get_frame_annotations(video_id, frame_id):
         print(f"Error getting frame annotations: {e}")
         return jsonify({"error": str(e)}), 500
 
+def load_coco_data(annotation_file):
+    """Load a video's COCO annotations, or an empty document if there are none yet"""
+    if os.path.exists(annotation_file):
+        with open(annotation_file, "r") as f:
+            return json.load(f)
+    return {
+        "images": [],
+        "annotations": [],
+        "categories": []
+    }
+
+def find_or_add_frame_image(coco_data, frame_id, width, height):
+    """Return the COCO image id for a frame, adding the image entry if it is missing"""
+    for image in coco_data.get("images", []):
+        if image.get("file_name") == f"{frame_id}.jpg":
+            return image.get("id")
+
+    image_id = int(datetime.now().timestamp())
+    coco_data["images"].append({
+        "id": image_id,
+        "file_name": f"{frame_id}.jpg",
+        "width": width,
+        "height": height
+    })
+    return image_id
+
+def next_annotation_id(coco_data):
+    if not coco_data["annotations"]:
+        return 1
+    return max(ann.get("id", 0) for ann in coco_data["annotations"]) + 1
+
 @annotation_router.route("/save-frame", methods=["POST"])
 def save_frame_annotations():
     """Save annotations for a specific frame"""
@@ -309,34 +361,10 @@ def save_frame_annotations():
     
     try:
         # Create or load existing annotation file
-        if os.path.exists(annotation_file):
-            with open(annotation_file, "r") as f:
-                coco_data = json.load(f)
-        else:
-            coco_data = {
-                "images": [],
-                "annotations": [],
-                "categories": []
-            }
+        coco_data = load_coco_data(annotation_file)
             
-        # Check if this image is already in the images list
-        image_exists = False
-        image_id = None
-        for image in coco_data.get("images", []):
-            if image.get("file_name") == f"{frame_id}.jpg":
-                image_exists = True
-                image_id = image.get("id")
-                break
-                
-        # If not, add it
-        if not image_exists:
-            image_id = int(datetime.now().timestamp())
-            coco_data["images"].append({
-                "id": image_id,
-                "file_name": f"{frame_id}.jpg",
-                "width": width,
-                "height": height
-            })
+        # Find this frame's image, adding it if needed
+        image_id = find_or_add_frame_image(coco_data, frame_id, width, height)
             
         # Remove existing annotations for this image
         coco_data["annotations"] = [
@@ -345,9 +373,7 @@ def save_frame_annotations():
         ]
         
         # Add the new annotations for this image
-        next_ann_id = 1
-        if coco_data["annotations"]:
-            next_ann_id = max(ann.get("id", 0) for ann in coco_data["annotations"]) + 1
+        next_ann_id = next_annotation_id(coco_data)
             
         for i, ann in enumerate(annotations):
             ann["id"] = next_ann_id + i
@@ -363,6 +389,71 @@ def save_frame_annotations():
     except Exception as e:
         print(f"Error saving frame annotations: {e}")
         return jsonify({"error": str(e)}), 500
+
+@annotation_router.route("/save-frame-delta", methods=["POST"])
+def save_frame_annotations_delta():
+    """Apply only the changes to a frame's annotations: "added" annotations, "removed"
+    annotation ids and "modified" annotations (matched by id, other fields replaced).
+    Returns the number of annotations touched as rowsAffected."""
+    data = request.json
+    try:
+        video_id = data.get("video_id")
+        frame_id = data.get("frame_id")
+        width = data.get("width")
+        height = data.get("height")
+        added = list(data.get("added", []))
+        removed = set(data.get("removed", []))
+        modified = {ann["id"]: ann for ann in data.get("modified", []) if "id" in ann}
+        if not all(isinstance(ann, dict) for ann in added + list(modified.values())):
+            raise TypeError("annotations must be objects")
+    except (AttributeError, KeyError, TypeError) as e:
+        return jsonify({"error": f"Malformed annotation changes: {e}"}), 400
+
+    if not all([video_id, frame_id, width, height]):
+        return jsonify({"error": "Missing required fields"}), 400
+
+    annotation_file = get_annotation_path(video_id)
+
+    try:
+        coco_data = load_coco_data(annotation_file)
+        image_id = find_or_add_frame_image(coco_data, frame_id, width, height)
+
+        # Only this frame's annotations can be removed or modified
+        rows_affected = 0
+        kept = []
+        for ann in coco_data["annotations"]:
+            if ann.get("image_id") == image_id:
+                if ann.get("id") in removed:
+                    rows_affected += 1
+                    continue
+                changes = modified.get(ann.get("id"))
+                if changes is not None:
+                    ann.update(changes)
+                    ann["image_id"] = image_id
+                    rows_affected += 1
+            kept.append(ann)
+        coco_data["annotations"] = kept
+
+        next_ann_id = next_annotation_id(coco_data)
+        for i, ann in enumerate(added):
+            ann["id"] = next_ann_id + i
+            ann["image_id"] = image_id
+            coco_data["annotations"].append(ann)
+        rows_affected += len(added)
+
+        if rows_affected:
+            with open(annotation_file, "w") as f:
+                json.dump(coco_data, f, indent=4)
+
+        return jsonify({
+            "message": "Frame annotations updated successfully",
+            "rowsAffected": rows_affected,
+            "added_ids": [ann["id"] for ann in added]
+        }), 200
+
+    except Exception as e:
+        print(f"Error saving frame annotation changes: {e}")
+        return jsonify({"error": str(e)}), 500
     
 
 @annotation_router.route("/get-rallies/<video_id>", methods=["GET"])
@@ -450,7 +541,7 @@ def update_frame_annotations():
             return jsonify({"error": f"Frame {frame_number}.jpg not found"}), 404
             
         # Path to save boxes in JSON
-        boxes_path = os.path.join(DATA_DIR, "bbox", f"{video_id}_boxes.json")
+        boxes_path = get_boxes_path(video_id)
         os.makedirs(os.path.dirname(boxes_path), exist_ok=True)
         
         # Log the incoming data
@@ -483,16 +574,11 @@ def update_frame_annotations():
         
         # Run pose estimation on the frame
         try:
-            from models.pose_estimation.tennis_analyzer import TennisPlayerAnalyzer
-            
-            print(f"Initializing TennisPlayerAnalyzer with:")
+            print(f"Using shared TennisPlayerAnalyzer with:")
             print(f"  frames_dir: {os.path.join(RAW_FRAMES_DIR, video_id)}")
             print(f"  bbox_file: {boxes_path}")
             
-            analyzer = TennisPlayerAnalyzer(
-                frames_dir=os.path.join(RAW_FRAMES_DIR, video_id),
-                bbox_file=boxes_path
-            )
+            analyzer = get_pose_analyzer(video_id)
             
             # Process this specific frame
             pose_coordinates_path = os.path.join(POSE_COORDINATES_DIR, f"{video_id}_pose.json")
@@ -513,10 +599,12 @@ def update_frame_annotations():
                 
             # Process just this specific frame
             print(f"Processing frame {frame_number}...")
-            frame_with_poses, processed_frame_number, all_poses = analyzer.process_frame(
-                frame_path=Path(frame_path),
-                all_poses=all_poses
-            )
+            with analyzer.lock:
+                analyzer.reload_boxes(boxes_path)
+                frame_with_poses, processed_frame_number, all_poses = analyzer.process_frame(
+                    frame_path=Path(frame_path),
+                    all_poses=all_poses
+                )
             
             # Verify the results
             frame_key = f"frame_{frame_number}"
@@ -1,13 +1,13 @@
-from flask import Blueprint, request, jsonify, send_from_directory
-import torch
-import cv2
-import numpy as np
+from flask import Blueprint, request, jsonify
 import os
 import json
 import subprocess
-from multiprocessing import Pool
-from models.pose_estimation.tennis_analyzer import TennisPlayerAnalyzer
-from routes.annotation import parse_image_url
+import sys
+import tempfile
+import threading
+import time
+from routes.annotation import parse_image_url, get_pose_analyzer
+from routes.util import cached_by_stat, load_json_cached, send_data_file
 
 # Blueprint for inference routes
 inference_router = Blueprint("inference", __name__)
@@ -20,79 +20,161 @@ GROUNDING_DINO_TRAINING_DIR = os.path.join(BASE_DIR, "grounding_dino_training")
 PREDICTIONS_DIR = os.path.join(BASE_DIR, "grounding_frames")
 POSE_DIR = os.path.join(BASE_DIR, "pose_frames")
 
+# Per-video paths, formatted with the video id
+FRAMES_DIR_TPL = os.path.join(RAW_FRAMES_DIR, "{}")
+MODEL_PATH_TPL = os.path.join(GROUNDING_DINO_OUTPUT_DIR, "{}", "checkpoint0014.pth")
+LABELS_PATH_TPL = os.path.join(GROUNDING_DINO_TRAINING_DIR, "{}", "label.json")
+PREDICTIONS_DIR_TPL = os.path.join(PREDICTIONS_DIR, "{}")
+POSE_DIR_TPL = os.path.join(POSE_DIR, "{}")
+BOXES_PATH_TPL = os.path.join(BASE_DIR, "bbox", "{}_boxes.json")
+# Key of the inputs the current predictions were made from, written after a successful run
+INFERENCE_KEY_PATH_TPL = os.path.join(PREDICTIONS_DIR, "{}", ".inference.key")
+
 # GroundingDINO paths
-# INFERENCE_SCRIPT = os.path.join("models", "grounding_dino", "GroundingDINO", "inference_on_a_image.py")
-INFERENCE_SCRIPT = os.path.join("models", "grounding_dino", "GroundingDINO", "inference_on_a_folder.py")
 CONFIG_PATH = os.path.join("models", "grounding_dino", "GroundingDINO", "tools", "GroundingDINO_SwinT_OGC.py")
 
+# Run each inference job in a fresh interpreter instead of the resident model (opt-in fallback)
+INFERENCE_SUBPROCESS = os.environ.get("GROUNDING_DINO_SUBPROCESS", "0") == "1"
+INFERENCE_MODULE = "models.grounding_dino.infer_module"
+
+# Loaded GroundingDINO models, keyed by checkpoint path
+MAX_LOADED_MODELS = 2
+_INFERENCERS = {}
+_INFERENCERS_LOCK = threading.Lock()
+
 inferring_status = {"running": False, "last_status": None}
+# Held for the duration of a /run request
+_run_lock = threading.Lock()
+
+FRAME_EXTENSIONS = (".jpg", ".png")
+
+def _frame_sort_key(name):
+    """Order frames numerically by their leading frame number (0001.jpg, 0001_pred.jpg)"""
+    stem = name.split('_', 1)[0].split('.', 1)[0]
+    return (0, int(stem), name) if stem.isdigit() else (1, 0, name)
+
+def list_frames(directory):
+    """Frame image names in directory, in frame order"""
+    with os.scandir(directory) as entries:
+        frames = [entry.name for entry in entries if entry.name.endswith(FRAME_EXTENSIONS) and entry.is_file()]
+    frames.sort(key=_frame_sort_key)
+    return frames
 
 def get_video_specific_paths(video_id):
     """Helper function to get video-specific paths."""
     return {
-        'frames_dir': os.path.join(RAW_FRAMES_DIR, video_id),
-        'model_path': os.path.join(GROUNDING_DINO_OUTPUT_DIR, video_id, "checkpoint0014.pth"),
-        'labels_path': os.path.join(GROUNDING_DINO_TRAINING_DIR, video_id, "label.json"),
-        'predictions_dir': os.path.join(PREDICTIONS_DIR, video_id)
+        'frames_dir': FRAMES_DIR_TPL.format(video_id),
+        'model_path': MODEL_PATH_TPL.format(video_id),
+        'labels_path': LABELS_PATH_TPL.format(video_id),
+        'predictions_dir': PREDICTIONS_DIR_TPL.format(video_id)
     }
 
-def process_frame(frame_info):
-    """Helper function to process a single frame."""
+def _get_inferencer(model_path):
+    """Return a resident GroundingDINO inferencer for model_path, reloading it if the
+    checkpoint has been retrained since it was loaded."""
+    mtime = os.stat(model_path).st_mtime_ns
+    with _INFERENCERS_LOCK:
+        cached = _INFERENCERS.get(model_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        _INFERENCERS.pop(model_path, None)
+        while len(_INFERENCERS) >= MAX_LOADED_MODELS:
+            _INFERENCERS.pop(next(iter(_INFERENCERS)))
+
+        print(f"Loading GroundingDINO checkpoint {model_path}")
+        # Imported here so GroundingDINO (and its CUDA setup) only loads once a model is needed
+        from models.grounding_dino.infer_module import Inferencer
+        inferencer = Inferencer(CONFIG_PATH, model_path)
+        _INFERENCERS[model_path] = (mtime, inferencer)
+        return inferencer
+
+def preload_model(video_id):
+    """Load a video's checkpoint into the resident inferencer ahead of its first /run"""
+    if INFERENCE_SUBPROCESS:
+        return
+    model_path = MODEL_PATH_TPL.format(video_id)
+    try:
+        _get_inferencer(model_path)
+    except Exception as e:
+        print(f"Failed to preload GroundingDINO checkpoint {model_path}: {e}")
+
+@cached_by_stat()
+def load_labels(labels_path):
+    """Caption string for a video's label file, rebuilt only when the file changes"""
+    json_data = load_json_cached(labels_path)
+    return ".".join(json_data[key] for key in json_data)
+
+def inference_key(paths, labels, frames):
+    """Identifies one inference run: the checkpoint version, the caption and the frame set"""
+    model_stat = os.stat(paths['model_path'])
+    frames_mtime = os.stat(paths['frames_dir']).st_mtime_ns
+    return f"{model_stat.st_mtime_ns}:{model_stat.st_size}:{frames_mtime}:{len(frames)}:{labels}"
+
+def has_cached_results(video_id, key):
+    """True if the last successful run used the same inputs and its outputs are still there"""
+    try:
+        with open(INFERENCE_KEY_PATH_TPL.format(video_id), 'r') as f:
+            if f.read() != key:
+                return False
+    except FileNotFoundError:
+        return False
+    return os.path.exists(BOXES_PATH_TPL.format(video_id)) and os.path.isdir(POSE_DIR_TPL.format(video_id))
+
+def run_inference_subprocess(video_id, frame_info):
+    """Run a job through `python -m models.grounding_dino.infer_module --manifest`"""
     frame_path, predictions_dir, model_path, labels = frame_info
-    
-    command = [
-        "python", INFERENCE_SCRIPT,
-        "-c", CONFIG_PATH,
-        "-p", model_path,
-        "-i", frame_path,
-        "-t", labels,
-        "-o", predictions_dir
-    ]
-
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-
-    if process.returncode != 0:
-        return f"Inference failed for {frame_path}: {stderr.decode('utf-8')}"
-    return None  # Success
+    from models.grounding_dino.infer_module import write_manifest
+    # A private, uniquely named file per job (mkstemp creates it 0600)
+    fd, manifest_path = tempfile.mkstemp(prefix=f"gd_manifest_{video_id}_", suffix=".json")
+    os.close(fd)
+    try:
+        write_manifest(manifest_path, frame_path, predictions_dir, model_path, labels, CONFIG_PATH)
+        subprocess.run([sys.executable, "-m", INFERENCE_MODULE, "--manifest", manifest_path], check=True)
+    finally:
+        os.remove(manifest_path)
 
 def process_frames(video_id, frame_info):
     """Helper function to process all frames in a folder."""
     frame_path, predictions_dir, model_path, labels = frame_info
-    
-    command = [
-        "python", INFERENCE_SCRIPT,
-        "-c", CONFIG_PATH,
-        "-p", model_path,
-        "-i", os.path.join(frame_path),
-        "-t", labels,
-        "-o", predictions_dir
-    ]
-
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-    # process = subprocess.run(command)
-
-    if process.returncode != 0:
-        print(f"Inference failed for {frame_path}: {stderr.decode('utf-8')}")
-        return f"Inference failed for {frame_path}: {stderr.decode('utf-8')}"
+
+    try:
+        if INFERENCE_SUBPROCESS:
+            run_inference_subprocess(video_id, frame_info)
+        else:
+            _get_inferencer(model_path).predict_folder(frame_path, labels, predictions_dir)
+    except Exception as e:
+        print(f"Inference failed for {frame_path}: {e}")
+        return f"Inference failed for {frame_path}: {e}"
     return None  # Success
 
 def process_pose(video_id, frame_info):
     frame_path, predictions_dir, model_path, labels = frame_info
-    json_file = os.path.join("data", "bbox", f"{video_id}_boxes.json")
+    json_file = BOXES_PATH_TPL.format(video_id)
     print(f'Processing poses for video: {video_id} with json file: {json_file} and frame_path: {frame_path}')
     
-    analyzer = TennisPlayerAnalyzer(frame_path, json_file)
-    analyzer.process_frames(POSE_DIR, video_id)
+    analyzer = get_pose_analyzer(video_id)
+    with analyzer.lock:
+        analyzer.reload_boxes(json_file)
+        analyzer.process_frames(POSE_DIR, video_id)
     
     return None
 
 @inference_router.route("/run", methods=["POST"])
 def run_model():
-    """Run inference on all frames in parallel using multiprocessing."""
+    """Run inference on all frames, one request at a time. Reruns with unchanged inputs are
+    answered from the previous results unless ?nocache=1 is passed."""
+    if not _run_lock.acquire(blocking=False):
+        return jsonify({"error": "Inference is already in progress"}), 400
+    try:
+        return _run_model()
+    finally:
+        inferring_status["running"] = False
+        _run_lock.release()
+
+def _run_model():
     print(f"Starting inference on all frames")
-    global inferring_status
+    started = time.perf_counter()
     inferring_status["running"] = True
 
     data = request.json
@@ -106,18 +188,34 @@ def run_model():
         
     # Read labels
     try:
-        with open(paths['labels_path'], 'r') as f:
-            json_data = json.load(f)
-        labels = ".".join(json_data[key] for key in json_data)
+        labels = load_labels(paths['labels_path'])
     except FileNotFoundError:
         return jsonify({"error": "Labels file not found"}), 404
     except json.JSONDecodeError:
         return jsonify({"error": "Invalid labels file"}), 400
     
-    frames = sorted(f for f in os.listdir(paths['frames_dir']) if f.endswith((".jpg", ".png")))
+    frames = list_frames(paths['frames_dir'])
     if not frames:
         return jsonify({"error": "No frames found"}), 404
 
+    try:
+        key = inference_key(paths, labels, frames)
+    except FileNotFoundError:
+        return jsonify({"error": "Model checkpoint not found"}), 404
+    key_path = INFERENCE_KEY_PATH_TPL.format(video_id)
+    if request.args.get("nocache") != "1" and has_cached_results(video_id, key):
+        print(f"Inference inputs unchanged for {video_id}, reusing previous results")
+        inferring_status["last_status"] = "Inference completed successfully."
+        return jsonify({
+            "message": "Inference completed for all frames",
+            "cached": True,
+            "elapsed_ms": (time.perf_counter() - started) * 1000
+        }), 200
+
+    # Invalidate the previous results before they start being overwritten
+    if os.path.exists(key_path):
+        os.remove(key_path)
+
     frame_info_list = (paths['frames_dir'], paths['predictions_dir'], paths['model_path'], labels)
 
     res = process_frames(video_id, frame_info_list)
@@ -134,11 +232,18 @@ def run_model():
     #     return jsonify({"error": inferring_status["last_status"]}), 500
 
     process_pose(video_id, frame_info_list)
+
+    with open(key_path, 'w') as f:
+        f.write(key)
     
     inferring_status["running"] = False
     inferring_status["last_status"] = "Inference completed successfully."
     print("Inference completed for all frames")
-    return jsonify({"message": "Inference completed for all frames"}), 200
+    return jsonify({
+        "message": "Inference completed for all frames",
+        "cached": False,
+        "elapsed_ms": (time.perf_counter() - started) * 1000
+    }), 200
 
 @inference_router.route("/run/status", methods=["GET"])
 def get_inference_status():
@@ -153,24 +258,30 @@ def get_extracted_frames(video_id):
     video_id = video_id.split('.')[0]
     
     """Retrieve list of frames for a specific video"""
-    predictions_dir = os.path.join(PREDICTIONS_DIR, video_id)    
+    predictions_dir = PREDICTIONS_DIR_TPL.format(video_id)    
 
-    if not os.path.exists(predictions_dir):
+    try:
+        frames = list_frames(predictions_dir)
+    except FileNotFoundError:
         return jsonify({"error": "No predictions found for this video"}), 404
 
-    frames = sorted(os.listdir(predictions_dir))    
     return jsonify({"frames": frames})
 
 @inference_router.route("/frame/<video_id>/<path:filename>")
 def serve_frame(video_id, filename):
     """Serve individual frame images from predictions"""
     video_id = video_id.split('.')[0]
-    predictions_dir = os.path.join(POSE_DIR, video_id)
+    predictions_dir = POSE_DIR_TPL.format(video_id)
     
     if not os.path.exists(os.path.join(predictions_dir, filename)):
         return jsonify({"error": "Prediction file does not exist"}), 404
         
-    return send_from_directory(predictions_dir, filename)
+    # Pose frames are re-rendered in place when annotations are edited, so they can't be
+    # marked immutable; let the browser keep them and revalidate by ETag (a 304 skips the read)
+    response = send_data_file(predictions_dir, filename, conditional=True, etag=True)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
 
 
 @inference_router.route("/check-readiness/<video_id>", methods=["GET"])
@@ -180,8 +291,8 @@ def check_inference_readiness(video_id):
         return jsonify({"error": "video_id is required"}), 400
         
     # Get paths for the necessary files
-    model_path = os.path.join(GROUNDING_DINO_OUTPUT_DIR, video_id, "checkpoint0014.pth")
-    labels_path = os.path.join(GROUNDING_DINO_TRAINING_DIR, video_id, "label.json")
+    model_path = MODEL_PATH_TPL.format(video_id)
+    labels_path = LABELS_PATH_TPL.format(video_id)
     
     # Check if required files exist
     model_exists = os.path.exists(model_path)
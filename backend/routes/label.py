@@ -1,7 +1,6 @@
 from flask import Blueprint, request, jsonify
 import os
-import json
-import shutil
+from routes.util import load_json, dump_json, load_json_cached, copy_file
 
 # Create blueprint
 label_router = Blueprint("label", __name__)
@@ -12,6 +11,10 @@ GENERATED_LABELS_DIR = os.path.join(DATA_DIR, "generated_labels")
 CONFIRMED_LABELS_DIR = os.path.join(DATA_DIR, "confirmed_labels")
 POSE_DIR = os.path.join(DATA_DIR, "pose_frames")
 
+# Per-video label file paths, formatted with the video id
+GENERATED_LABELS_TPL = os.path.join(GENERATED_LABELS_DIR, "{}_labelled.json")
+CONFIRMED_LABELS_TPL = os.path.join(CONFIRMED_LABELS_DIR, "{}_labelled.json")
+
 # Ensure output directories exist
 os.makedirs(GENERATED_LABELS_DIR, exist_ok=True)
 os.makedirs(CONFIRMED_LABELS_DIR, exist_ok=True)
@@ -20,7 +23,7 @@ os.makedirs(CONFIRMED_LABELS_DIR, exist_ok=True)
 def check_label_file(video_id):
     """Check if generated label file exists for a video."""
     # First check in confirmed labels
-    confirmed_path = os.path.join(CONFIRMED_LABELS_DIR, f"{video_id}_labelled.json")
+    confirmed_path = CONFIRMED_LABELS_TPL.format(video_id)
     if os.path.exists(confirmed_path):
         return jsonify({
             "exists": True, 
@@ -29,7 +32,7 @@ def check_label_file(video_id):
         }), 200
     
     # Then check in generated labels
-    generated_path = os.path.join(GENERATED_LABELS_DIR, f"{video_id}_labelled.json")
+    generated_path = GENERATED_LABELS_TPL.format(video_id)
     if os.path.exists(generated_path):
         return jsonify({
             "exists": True, 
@@ -46,30 +49,28 @@ def check_label_file(video_id):
 def get_labels(video_id):
     """Get shot labels for a specific video, preferring confirmed labels if available."""
     # First check in confirmed labels
-    confirmed_path = os.path.join(CONFIRMED_LABELS_DIR, f"{video_id}_labelled.json")
-    if os.path.exists(confirmed_path):
-        try:
-            with open(confirmed_path, 'r') as f:
-                labels_data = json.load(f)
-            return jsonify({
-                "data": labels_data,
-                "source": "confirmed"
-            }), 200
-        except Exception as e:
-            return jsonify({"error": f"Error reading confirmed label file: {str(e)}"}), 500
+    confirmed_path = CONFIRMED_LABELS_TPL.format(video_id)
+    try:
+        return jsonify({
+            "data": load_json_cached(confirmed_path),
+            "source": "confirmed"
+        })
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        return jsonify({"error": f"Error reading confirmed label file: {str(e)}"}), 500
     
     # Then check in generated labels
-    generated_path = os.path.join(GENERATED_LABELS_DIR, f"{video_id}_labelled.json")
-    if os.path.exists(generated_path):
-        try:
-            with open(generated_path, 'r') as f:
-                labels_data = json.load(f)
-            return jsonify({
-                "data": labels_data,
-                "source": "generated"
-            }), 200
-        except Exception as e:
-            return jsonify({"error": f"Error reading generated label file: {str(e)}"}), 500
+    generated_path = GENERATED_LABELS_TPL.format(video_id)
+    try:
+        return jsonify({
+            "data": load_json_cached(generated_path),
+            "source": "generated"
+        })
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        return jsonify({"error": f"Error reading generated label file: {str(e)}"}), 500
     
     return jsonify({"error": "Label file not found"}), 404
 
@@ -77,8 +78,8 @@ def get_labels(video_id):
 def update_label(video_id):
     """Update a specific shot label and save to confirmed labels directory."""
     # First determine the source file
-    confirmed_path = os.path.join(CONFIRMED_LABELS_DIR, f"{video_id}_labelled.json")
-    generated_path = os.path.join(GENERATED_LABELS_DIR, f"{video_id}_labelled.json")
+    confirmed_path = CONFIRMED_LABELS_TPL.format(video_id)
+    generated_path = GENERATED_LABELS_TPL.format(video_id)
     
     # Choose the path to read from (prefer confirmed if exists)
     source_path = confirmed_path if os.path.exists(confirmed_path) else generated_path
@@ -92,8 +93,7 @@ def update_label(video_id):
     
     try:
         # Load the current labels file
-        with open(source_path, 'r') as f:
-            labels_data = json.load(f)
+        labels_data = load_json(source_path)
         
         # Update the specified label
         rally_index = data['rallyIndex']
@@ -111,9 +111,11 @@ def update_label(video_id):
         # Update the event
         labels_data['rallies'][rally_index]['events'][event_index] = updated_event
         
-        # Always save to confirmed labels directory
-        with open(confirmed_path, 'w') as f:
-            json.dump(labels_data, f, indent=2)
+        # Always save to confirmed labels directory; write a new file and swap it in so a
+        # failed write never leaves a truncated confirmed file
+        tmp_path = f"{confirmed_path}.tmp"
+        dump_json(labels_data, tmp_path, indent=2)
+        os.replace(tmp_path, confirmed_path)
         
         return jsonify({
             "message": "Label updated successfully",
@@ -125,15 +127,18 @@ def update_label(video_id):
 @label_router.route("/confirm/<video_id>", methods=["POST"])
 def confirm_labels(video_id):
     """Copy generated labels to confirmed labels directory."""
-    generated_path = os.path.join(GENERATED_LABELS_DIR, f"{video_id}_labelled.json")
-    confirmed_path = os.path.join(CONFIRMED_LABELS_DIR, f"{video_id}_labelled.json")
+    generated_path = GENERATED_LABELS_TPL.format(video_id)
+    confirmed_path = CONFIRMED_LABELS_TPL.format(video_id)
     
     if not os.path.exists(generated_path):
         return jsonify({"error": "Generated label file not found"}), 404
     
     try:
-        # Copy file from generated to confirmed directory
-        shutil.copy2(generated_path, confirmed_path)
+        # A real copy, not a hardlink: the shot labelling model rewrites the generated file in
+        # place, which would otherwise overwrite the confirmed labels through the shared inode
+        tmp_path = f"{confirmed_path}.tmp"
+        copy_file(generated_path, tmp_path)
+        os.replace(tmp_path, confirmed_path)
         return jsonify({
             "message": "Labels confirmed successfully",
             "source": generated_path,
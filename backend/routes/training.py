@@ -1,13 +1,18 @@
+import hashlib
 import json
 import re
 import os
 import subprocess
+import sys
 import threading
 import time
 import shutil
+from collections import deque
+from dataclasses import dataclass, asdict, replace
 from datetime import datetime
 from flask import Blueprint, request, jsonify
-from routes.util import split_dataset, modify_coco_2_odvg, modify_config_files
+from routes.inference import preload_model
+from routes.util import split_dataset, modify_coco_2_odvg, modify_config_files, TRAINING_CONFIG_TPL, TRAINING_DATASETS_TPL
 
 import yapf
 # import routes.numpy_patch
@@ -25,22 +30,60 @@ TRAINING_DIR = os.path.join(DATA_DIR, "grounding_dino_training")
 CONFIG_DIR = "config"
 OUTPUT_DIR = os.path.join(DATA_DIR, "grounding_dino_output")
 
+# Per-video paths, formatted with the video id
+ANNOTATION_PATH_TPL = os.path.join(ANNOTATIONS_DIR, "{}_coco_annotations.json")
+CHECKPOINT_PATH_TPL = os.path.join(OUTPUT_DIR, "{}", "checkpoint0014.pth")
+# Hash of the annotations the checkpoint was trained on, written when training succeeds
+TRAINED_HASH_PATH_TPL = os.path.join(OUTPUT_DIR, "{}", ".annotations.hash")
+
 # Create necessary directories
 for directory in [ANNOTATIONS_DIR, TRAINING_DIR, CONFIG_DIR, OUTPUT_DIR]:
     os.makedirs(directory, exist_ok=True)
 
 # Configuration and model paths
-CONFIG_PATH = os.path.join(GROUNDING_DINO_PATH, CONFIG_DIR, "cfg_odvg.py")
-DATASET_PATH = os.path.join(GROUNDING_DINO_PATH, CONFIG_DIR, "datasets_mixed_odvg.json")
 TRAIN_SCRIPT = "main.py"
 INPUT_PARAMS_PATH = os.path.join(GROUNDING_DINO_PATH, "input_params.json")
 MODEL_CHECKPOINT = os.path.join(OUTPUT_DIR, "checkpoint.pth")
+PRETRAIN_MODEL_PATH = "models/grounding_dino/weights/groundingdino_swint_ogc.pth"
+TEXT_ENCODER_PATH = "models/grounding_dino/bert"
+
+# Lines of training output kept for the failure message
+TRAINING_LOG_TAIL = 20
+
+@dataclass(frozen=True)
+class TrainingStatus:
+    running: bool = False
+    last_status: str | None = None
+
+# Replaced wholesale on every update, so readers always see a consistent snapshot
+training_status = TrainingStatus()
+
+# Held from /train/start until the training job finishes
+_train_lock = threading.Lock()
+# Serializes status updates, so the monitor thread and /train/reset can't drop each other's
+_status_lock = threading.Lock()
 
-training_status = {"running": False, "last_status": None}
+def set_training_status(**changes):
+    """Publish a new status snapshot"""
+    global training_status
+    with _status_lock:
+        training_status = replace(training_status, **changes)
 
 def get_annotation_path(video_id):
     """Get path for video's annotation file"""
-    return os.path.join(ANNOTATIONS_DIR, f"{video_id}_coco_annotations.json")
+    return ANNOTATION_PATH_TPL.format(video_id)
+
+def annotations_hash(raw):
+    return hashlib.sha256(raw).hexdigest()
+
+def is_trained_on(video_id, key):
+    """True if the video's checkpoint exists and was trained on annotations hashing to key"""
+    try:
+        with open(TRAINED_HASH_PATH_TPL.format(video_id), 'r') as f:
+            trained_key = f.read().strip()
+    except FileNotFoundError:
+        return False
+    return trained_key == key and os.path.exists(CHECKPOINT_PATH_TPL.format(video_id))
 
 def update_configurations(video_id, categories):
     """Modifies dataset configuration files before training."""
@@ -53,80 +96,113 @@ def update_configurations(video_id, categories):
         os.makedirs(CONFIG_DIR, exist_ok=True)
         
         # 1. Split training sets
-        split_dataset(
+        train_split = split_dataset(
             annotations_path=get_annotation_path(video_id),
             output_dir=video_training_dir,
             video_id=video_id
         )
         print(f"Step 1: Split dataset for video {video_id}")
         
-        # 2. Update coco2odvg.py
-        modify_coco_2_odvg(categories, video_id)
-        print(f"Step 2: Modify coco2odvg.py")
+        # 2. Convert the train split to ODVG with this video's category map
+        modify_coco_2_odvg(categories, video_id, train_split)
+        print(f"Step 2: Convert train split to ODVG")
 
-        # 3. Modify cfg_odvg.py
-        modify_config_files(categories)
-        print(f"Step 3: Modify cfg_odvg.py")
+        # 3. Write this video's cfg_odvg.py
+        modify_config_files(categories, video_id)
+        print(f"Step 3: Write cfg_odvg.py")
         return True
     
     except Exception as e:
         print(f"Error updating configurations: {e}")
         return False
 
-def run_training(video_id, categories):
+def build_training_command(video_id, output_dir):
+    """Command line for GroundingDINO's main.py, using the video's generated configs.
+
+    Training stays in a child interpreter: main.py imports its own top-level `models`
+    package, which clashes with ours, and a killable child keeps GPU memory isolated."""
+    return [
+        sys.executable, os.path.join(GROUNDING_DINO_PATH, TRAIN_SCRIPT),
+        "--config_file", TRAINING_CONFIG_TPL.format(video_id),
+        "--datasets", TRAINING_DATASETS_TPL.format(video_id),
+        "--output_dir", output_dir,
+        "--pretrain_model_path", PRETRAIN_MODEL_PATH,
+        "--options", f"text_encoder_type={TEXT_ENCODER_PATH}",
+    ]
+
+def run_training(video_id, categories, key):
     """Runs GroundingDINO fine-tuning process in a separate thread."""
     print(f"Running training for video {video_id}")
-    global training_status
-    training_status["running"] = True
-    training_status["last_status"] = "Initializing training..."
+    set_training_status(running=True, last_status="Initializing training...")
 
     try:
         if not update_configurations(video_id, categories):
             raise Exception("Failed to update config files")
 
         # Update status after configuration
-        training_status["last_status"] = "Configurations updated, starting training process..."
+        set_training_status(last_status="Configurations updated, starting training process...")
             
         # Create video-specific output directory
         video_output_dir = os.path.join(OUTPUT_DIR, video_id)
         os.makedirs(video_output_dir, exist_ok=True)
 
-        command = [
-            "python", os.path.join(GROUNDING_DINO_PATH, TRAIN_SCRIPT),
-            "--config_file", CONFIG_PATH,
-            "--datasets", DATASET_PATH,
-            "--output_dir", video_output_dir,
-            "--pretrain_model_path", "models/grounding_dino/weights/groundingdino_swint_ogc.pth",
-            "--options", "text_encoder_type=models/grounding_dino/bert",
-        ]
+        command = build_training_command(video_id, video_output_dir)
 
         # Update status before starting subprocess
-        training_status["last_status"] = "Running training process..."
+        set_training_status(last_status="Running training process...")
         
+        # Merge stderr into stdout and read it line by line: communicate() buffered the whole
+        # log until exit, and an undrained pipe can wedge a long training run
         process = subprocess.Popen(
-            command, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env={**os.environ, "PYTHONUNBUFFERED": "1"},
         )
-        
+
         # Don't wait for process to complete - just update status that it's running
-        training_status["last_status"] = "Training in progress..."
-        
+        set_training_status(last_status="Training in progress...")
+
         # Start a monitoring thread that doesn't block the main flow
         def monitor_process():
-            stdout, stderr = process.communicate()
-            print(f'process return code: {process.returncode}')
-            
-            if process.returncode != 0:
-                error_msg = stderr.decode("utf-8")
-                print(f'Training failed for video {video_id}: {error_msg}')
-                training_status["last_status"] = f"Training failed: {error_msg[:100]}..."
-            else:
-                print(f"Training completed for video {video_id}")
-                training_status["last_status"] = "Training completed successfully."
-            
-            training_status["running"] = False
-            
+            succeeded = False
+            try:
+                tail = deque(maxlen=TRAINING_LOG_TAIL)
+                for raw_line in iter(process.stdout.readline, b''):
+                    line = raw_line.decode("utf-8", errors="replace").rstrip()
+                    if not line:
+                        continue
+                    tail.append(line)
+                    set_training_status(last_status=line[:200])
+                process.stdout.close()
+                process.wait()
+                print(f'process return code: {process.returncode}')
+
+                if process.returncode != 0:
+                    error_msg = "\n".join(tail)
+                    print(f'Training failed for video {video_id}: {error_msg}')
+                    set_training_status(running=False, last_status=f"Training failed: {error_msg[-100:]}...")
+                else:
+                    print(f"Training completed for video {video_id}")
+                    with open(TRAINED_HASH_PATH_TPL.format(video_id), 'w') as f:
+                        f.write(key)
+                    set_training_status(running=False, last_status="Training completed successfully.")
+                    succeeded = True
+            except Exception as e:
+                # Never leave the UI polling a job that is no longer being watched
+                print(f"Error monitoring training for video {video_id}: {e}")
+                if process.poll() is None:
+                    process.kill()
+                set_training_status(running=False, last_status=f"Training error: {str(e)}")
+            finally:
+                _train_lock.release()
+
+            # The checkpoint is about to be used for inference, so load it while the user
+            # reviews the results. Done after releasing the lock, so a new job can start
+            # as soon as the status says training has finished.
+            if succeeded:
+                preload_model(video_id)
+
         # Start monitoring in a separate thread
         monitor_thread = threading.Thread(target=monitor_process)
         monitor_thread.daemon = True
@@ -137,21 +213,32 @@ def run_training(video_id, categories):
 
     except Exception as e:
         print(f"Error running training: {e}")
-        training_status["last_status"] = f"Training error: {str(e)}"
-        training_status["running"] = False
+        set_training_status(running=False, last_status=f"Training error: {str(e)}")
+        _train_lock.release()
 
 @training_router.route("/train/start", methods=["POST"])
 def start_training():
     """Starts fine-tuning the GroundingDINO model."""
-    global training_status
-
-    if training_status["running"]:
+    # Taken without blocking so two concurrent requests can't both start a job; from here
+    # on the lock belongs to the training job and is released when it finishes
+    if not _train_lock.acquire(blocking=False):
         print(f'Training already in progress')
         return jsonify({
             "status": "error", 
             "message": "Training is already in progress."
         }), 400
 
+    started = False
+    try:
+        response, status, started = _start_training()
+        return response, status
+    finally:
+        if not started:
+            _train_lock.release()
+
+def _start_training():
+    """Validates the request and starts the training thread.
+    Returns (response, status, started), where started means a training thread now owns the lock."""
     # Get video_id from request
     print(f"Starting training")
     data = request.json
@@ -160,7 +247,7 @@ def start_training():
         return jsonify({
             "status": "error", 
             "message": "video_id is required"
-        }), 400
+        }), 400, False
 
     # Check for annotations file
     annotation_file = get_annotation_path(video_id)
@@ -168,11 +255,24 @@ def start_training():
         return jsonify({
             "status": "error", 
             "message": f"Annotations not found for video {video_id}"
-        }), 404
+        }), 404, False
 
     # Load and validate categories
-    with open(annotation_file, 'r') as f:
-        categories = json.load(f)["categories"]
+    with open(annotation_file, 'rb') as f:
+        raw = f.read()
+    categories = json.loads(raw)["categories"]
+
+    # Skip training when the checkpoint was already trained on exactly these annotations
+    key = annotations_hash(raw)
+    if is_trained_on(video_id, key):
+        print(f"Reusing checkpoint for video {video_id}, annotations unchanged")
+        set_training_status(running=False, last_status="Training completed successfully (annotations unchanged, reused existing model).")
+        return jsonify({
+            "status": "success",
+            "message": "Model already trained on these annotations.",
+            "model_path": CHECKPOINT_PATH_TPL.format(video_id),
+            "is_cached": True
+        }), 200, False
         
     # Clear the output directory first to ensure clean training
     video_output_dir = os.path.join(OUTPUT_DIR, video_id)
@@ -191,28 +291,24 @@ def start_training():
     # Start training in background
     training_thread = threading.Thread(
         target=run_training, 
-        args=(video_id, categories)
+        args=(video_id, categories, key)
     )
     training_thread.start()
 
     return jsonify({
         "status": "success", 
-        "message": "Training started."
-    }), 200
+        "message": "Training started.",
+        "is_cached": False
+    }), 200, True
     
 @training_router.route("/train/status", methods=["GET"])
 def get_training_status():
     """Returns the current status of the training process."""
-    return jsonify({
-        "running": training_status["running"],
-        "last_status": training_status["last_status"],
-    })
+    return jsonify(asdict(training_status))
 
 @training_router.route("/train/reset", methods=["POST"])
 def reset_training():
     """Resets the training environment for retraining."""
-    global training_status
-    
     data = request.json
     video_id = data.get("video_id")
     if not video_id:
@@ -220,7 +316,14 @@ def reset_training():
             "status": "error", 
             "message": "video_id is required"
         }), 400
-    
+
+    # Resetting under a running job would delete its output directory and report it stopped
+    if not _train_lock.acquire(blocking=False):
+        return jsonify({
+            "status": "error",
+            "message": "Training is in progress; wait for it to finish before resetting."
+        }), 400
+
     try:
         # Clean up output directory for this video
         video_output_dir = os.path.join(OUTPUT_DIR, video_id)
@@ -237,8 +340,7 @@ def reset_training():
             os.makedirs(video_output_dir, exist_ok=True)
         
         # Reset training status
-        training_status["running"] = False
-        training_status["last_status"] = "Environment reset, ready for training"
+        set_training_status(running=False, last_status="Environment reset, ready for training")
         
         return jsonify({
             "status": "success", 
@@ -248,4 +350,6 @@ def reset_training():
         return jsonify({
             "status": "error", 
             "message": f"Failed to reset training environment: {str(e)}"
-        }), 500
\ No newline at end of file
+        }), 500
+    finally:
+        _train_lock.release()
\ No newline at end of file
@@ -1,10 +1,25 @@
+import hashlib
 import json
 import random
 import os
 import re
 import shutil
-from transformers import AutoTokenizer, AutoModel
-from models.grounding_dino.GroundingDINO.tools.coco2odvg import coco2odvg
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+from flask import Response, abort, send_from_directory
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.security import safe_join
+from huggingface_hub import snapshot_download
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+from models.grounding_dino.GroundingDINO.tools.coco2odvg import coco2odvg, coco2odvg_from_objs
 
 # Directory Structure Constants
 BASE_DIR = "data"
@@ -12,30 +27,220 @@ ANNOTATIONS_DIR = os.path.join(BASE_DIR, "annotations")
 RAW_FRAMES_DIR = os.path.join(BASE_DIR, "raw_frames")
 TRAINING_DIR = os.path.join(BASE_DIR, "grounding_dino_training")
 
+# Per-video training configs, generated from GroundingDINO's templates and formatted with the video id
+TRAINING_CONFIG_TPL = os.path.join(TRAINING_DIR, "{}", "cfg_odvg.py")
+TRAINING_DATASETS_TPL = os.path.join(TRAINING_DIR, "{}", "datasets_mixed_odvg.json")
+
 # Model Constants
 GROUNDING_DINO_PATH = "models/grounding_dino/"
 BERT_DIR = os.path.join(GROUNDING_DINO_PATH, "bert")
+BERT_REPO_ID = "bert-base-uncased"
+# Config, tokenizer files and the safetensors weights; skips the TF/Flax/ONNX/CoreML copies
+BERT_ALLOW_PATTERNS = ["*.json", "*.txt", "model.safetensors"]
 WEIGHTS_DIR = os.path.join(GROUNDING_DINO_PATH, "weights")
+GROUNDING_DINO_WEIGHTS_URL = "https://github.com/IDEA-Research/GroundingDINO/releases/download/v0.1.0-alpha/groundingdino_swint_ogc.pth"
+GROUNDING_DINO_WEIGHTS_PATH = os.path.join(WEIGHTS_DIR, "groundingdino_swint_ogc.pth")
+GROUNDING_DINO_WEIGHTS_SHA256 = "3b3ca2563c77c69f651d7bd133e97139c186df06231157a64c507099c52bc799"
+
+# Buffer size for downloads and hashing
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# When set (e.g. "/protected"), files under data/ are handed to nginx with X-Accel-Redirect
+# to <prefix>/<path relative to the backend>, e.g. /protected/data/raw_frames/<video>/0001.jpg
+X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX", "").rstrip("/")
+
+# Config rewrites for modify_config_files: drop any label_list assignment, and put the
+# new one right after use_coco_eval (swallowing the blank lines that followed it)
+_LABEL_LIST_RE = re.compile(r'^label_list\s*=\s*\[[^\]]*\][^\n]*\n?', re.MULTILINE)
+_USE_COCO_EVAL_RE = re.compile(r'^[^\n]*use_coco_eval[^\n]*(?:\n[ \t]*(?=\n))*\n?', re.MULTILINE)
 
 # Dataset split ratios
 TRAIN_RATIO = 0.7
 VAL_RATIO = 0.2
 TEST_RATIO = 0.1
 
+# Threads linking/copying frames into the split directories
+STAGING_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Key of the last ODVG conversion, stored next to each video's training files
+ODVG_HASH_FILE = ".cats.hash"
+
+def load_json(path):
+    """Parse a JSON file, with orjson when it is installed"""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def dump_json(obj, path, indent=None):
+    """Write obj to path as JSON, with orjson when it is installed (which only indents by 2)"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=option))
+        return
+    with open(path, 'w') as f:
+        json.dump(obj, f, indent=indent)
+
+class OrjsonJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, for jsonify() and request.get_json()"""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+def cached_by_stat(maxsize=64):
+    """lru_cache for functions of a single path, keyed on the path's (st_mtime_ns, st_size)
+    so the result is recomputed once the file or directory changes. Raises os.stat's
+    FileNotFoundError for a missing path. Cached results are shared between callers."""
+    def decorator(fn):
+        @lru_cache(maxsize=maxsize)
+        def cached(path, stamp):
+            return fn(path)
+
+        @wraps(fn)
+        def wrapper(path):
+            stat = os.stat(path)
+            return cached(path, (stat.st_mtime_ns, stat.st_size))
+        wrapper.cache_clear = cached.cache_clear
+        return wrapper
+    return decorator
+
+@cached_by_stat()
+def load_json_cached(path):
+    """Load a JSON file, reusing the parsed result until the file changes.
+    The result is shared between callers, so it must not be modified."""
+    return load_json(path)
+
+def send_data_file(directory, filename, **kwargs):
+    """send_from_directory, or an X-Accel-Redirect so nginx sends the file itself.
+    With app.use_x_sendfile (USE_X_SENDFILE=1) Flask emits X-Sendfile for Apache/lighttpd instead."""
+    if not X_ACCEL_REDIRECT_PREFIX:
+        return send_from_directory(directory, filename, **kwargs)
+
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    response = Response()
+    response.headers["X-Accel-Redirect"] = f"{X_ACCEL_REDIRECT_PREFIX}/{path.replace(os.sep, '/')}"
+    # Let nginx pick the Content-Type from the file extension
+    del response.headers["Content-Type"]
+    return response
+
 def init_models():
     """Initialize and download required models."""
-    # Download Bert if not present
-    if not os.path.exists(BERT_DIR):
+    # Download Bert if not present; the files are fetched as-is, without loading the model
+    # (config and tokenizer files are checked in, so look for the weights themselves)
+    if not os.path.exists(os.path.join(BERT_DIR, "model.safetensors")):
         os.makedirs(BERT_DIR, exist_ok=True)
-        tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
-        model = AutoModel.from_pretrained("bert-base-uncased")
-        tokenizer.save_pretrained(BERT_DIR)
-        model.save_pretrained(BERT_DIR)
+        snapshot_download(BERT_REPO_ID, local_dir=BERT_DIR, allow_patterns=BERT_ALLOW_PATTERNS)
 
-    # Download pre-trained GroundingDINO weights if not present
-    if not os.path.exists(WEIGHTS_DIR):
+    # Download pre-trained GroundingDINO weights if not present. download_file only moves a
+    # checkpoint into place once its hash is verified, so startup just checks it exists.
+    if not os.path.exists(GROUNDING_DINO_WEIGHTS_PATH):
         os.makedirs(WEIGHTS_DIR, exist_ok=True)
-        os.system("wget -q https://github.com/IDEA-Research/GroundingDINO/releases/download/v0.1.0-alpha/groundingdino_swint_ogc.pth -P weights/")
+        try:
+            download_file(GROUNDING_DINO_WEIGHTS_URL, GROUNDING_DINO_WEIGHTS_PATH, GROUNDING_DINO_WEIGHTS_SHA256)
+        except Exception as e:
+            print(f"Failed to download GroundingDINO weights: {e}")
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def download_file(url, dest, sha256=None):
+    """Stream url to dest through dest.part, resuming a previous partial download.
+    The file is only moved into place once its SHA-256 matches."""
+    part_path = dest + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    with requests.get(url, headers=headers, stream=True, timeout=60) as r:
+        if r.status_code == 416:
+            # The partial file is already complete (or bogus); let the hash check decide
+            mode = None
+        else:
+            r.raise_for_status()
+            # A 200 means the server ignored the range, so start over
+            mode = 'ab' if r.status_code == 206 else 'wb'
+        if mode:
+            r.raw.decode_content = True
+            with open(part_path, mode) as f:
+                shutil.copyfileobj(r.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+
+    if sha256 is not None:
+        actual = sha256_file(part_path)
+        if actual != sha256:
+            os.remove(part_path)
+            raise ValueError(f"SHA-256 mismatch for {url}: expected {sha256}, got {actual}")
+    os.replace(part_path, dest)
+
+def _copy_file_range(src, dst):
+    """Kernel-side copy; on btrfs/XFS this becomes a reflink"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+def copy_file(src, dst):
+    """Copy src to dst in the kernel: copy_file_range (a reflink where supported), then
+    shutil.copyfile (which uses sendfile on Linux)."""
+    if hasattr(os, "copy_file_range"):
+        try:
+            _copy_file_range(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+def stage_file(src, dst):
+    """Place src at dst without moving bytes through Python where possible:
+    hardlink, then copy_file."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    copy_file(src, dst)
+
+COCO_HEADER_ITEMS = ("images.item", "categories.item")
+
+def _load_coco_header(annotations_path):
+    """Read the images and categories of a COCO file in one streaming pass,
+    skipping over the (much larger) annotations array"""
+    collected = {prefix: [] for prefix in COCO_HEADER_ITEMS}
+    builder = None
+    with open(annotations_path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if builder is None:
+                if prefix in collected and event == "start_map":
+                    builder = ijson.ObjectBuilder()
+                    builder_prefix = prefix
+                else:
+                    continue
+            builder.event(event, value)
+            if prefix == builder_prefix and event == "end_map":
+                collected[builder_prefix].append(builder.value)
+                builder = None
+    return collected["images.item"], collected["categories.item"]
+
+def _iter_coco_annotations(annotations_path):
+    with open(annotations_path, 'rb') as f:
+        yield from ijson.items(f, "annotations.item", use_float=True)
 
 def split_dataset(annotations_path, output_dir, video_id):
     """
@@ -43,6 +248,9 @@ def split_dataset(annotations_path, output_dir, video_id):
         annotations_path: Path to the input COCO annotations file
         output_dir: Directory to save the split datasets
         video_id: ID of the video being processed
+
+    Returns:
+        The train split's COCO dict, for modify_coco_2_odvg
     """
     # Create output directories
     train_dir = os.path.join(output_dir, "train")
@@ -52,13 +260,16 @@ def split_dataset(annotations_path, output_dir, video_id):
     for dir_path in [train_dir, valid_dir, test_dir]:
         os.makedirs(dir_path, exist_ok=True)
 
-    # Load annotations
-    with open(annotations_path, "r") as f:
-        data = json.load(f)
-
-    images = data["images"]
-    annotations = data["annotations"]
-    categories = data["categories"]
+    # Load annotations; with ijson the annotations are streamed straight into their
+    # split instead of materializing the whole document first
+    if ijson is not None:
+        images, categories = _load_coco_header(annotations_path)
+        annotations = _iter_coco_annotations(annotations_path)
+    else:
+        data = load_json(annotations_path)
+        images = data["images"]
+        annotations = data["annotations"]
+        categories = data["categories"]
 
     # Shuffle images before splitting
     random.seed(0)  # For reproducibility
@@ -74,44 +285,54 @@ def split_dataset(annotations_path, output_dir, video_id):
     val_images = images[train_size:train_size + val_size]
     test_images = images[train_size + val_size:]
 
-    # Get image_id sets for quick lookup
-    train_ids = {img["id"] for img in train_images}
-    val_ids = {img["id"] for img in val_images}
-    test_ids = {img["id"] for img in test_images}
+    # Map each image_id to its split index for a single bucketing pass
+    split_map = {}
+    for split_index, split_images in enumerate((train_images, val_images, test_images)):
+        split_map.update((img["id"], split_index) for img in split_images)
 
-    # Split annotations based on image_id
-    train_annotations = [ann for ann in annotations if ann["image_id"] in train_ids]
-    val_annotations = [ann for ann in annotations if ann["image_id"] in val_ids]
-    test_annotations = [ann for ann in annotations if ann["image_id"] in test_ids]
+    # Split annotations based on image_id; annotations for unknown images are dropped
+    buckets = ([], [], [])
+    for ann in annotations:
+        split_index = split_map.get(ann["image_id"])
+        if split_index is not None:
+            buckets[split_index].append(ann)
+    train_annotations, val_annotations, test_annotations = buckets
 
     # Copy images to their respective directories and update file paths
     source_dir = os.path.join("data/raw_frames", video_id)
     
+    def stage_image(img, dest_dir):
+        # Get source and destination paths
+        source_path = os.path.join(source_dir, img["file_name"])
+        dest_path = os.path.join(dest_dir, img["file_name"])
+
+        # Link or copy the image
+        try:
+            stage_file(source_path, dest_path)
+        except Exception as e:
+            print(f"Error copying {source_path}: {e}")
+            return None
+
+        # Update image path in the metadata
+        img_copy = img.copy()
+        img_copy["file_name"] = os.path.basename(img["file_name"])
+        return img_copy
+
     def copy_and_update_images(image_list, dest_dir):
-        updated_images = []
-        for img in image_list:
-            # Get source and destination paths
-            source_path = os.path.join(source_dir, img["file_name"])
-            dest_path = os.path.join(dest_dir, img["file_name"])
-            
-            # Copy the image
-            try:
-                shutil.copy2(source_path, dest_path)
-            except Exception as e:
-                print(f"Error copying {source_path}: {e}")
-                continue
-                
-            # Update image path in the metadata
-            img_copy = img.copy()
-            img_copy["file_name"] = os.path.basename(img["file_name"])
-            updated_images.append(img_copy)
-            
-        return updated_images
+        # map() submits every copy up front and yields results in the split's order
+        return executor.map(lambda img: stage_image(img, dest_dir), image_list)
 
-    # Copy images and update metadata
-    train_images = copy_and_update_images(train_images, train_dir)
-    val_images = copy_and_update_images(val_images, valid_dir)
-    test_images = copy_and_update_images(test_images, test_dir)
+    # Copy images and update metadata; staging is IO-bound, so all three splits are
+    # queued on one shared thread pool before any results are collected
+    with ThreadPoolExecutor(max_workers=STAGING_WORKERS) as executor:
+        staged_splits = [
+            copy_and_update_images(train_images, train_dir),
+            copy_and_update_images(val_images, valid_dir),
+            copy_and_update_images(test_images, test_dir),
+        ]
+        train_images, val_images, test_images = (
+            [img for img in staged if img is not None] for staged in staged_splits
+        )
 
     # Prepare output paths and datasets
     datasets = {
@@ -132,22 +353,46 @@ def split_dataset(annotations_path, output_dir, video_id):
         }
     }
 
-    # Save split datasets
-    for path, dataset in datasets.items():
-        with open(path, "w") as f:
-            json.dump(dataset, f, indent=2)
+    # Save split datasets compactly (they are only read back by the training loader); the
+    # three files are independent, so write them concurrently (list() re-raises failures)
+    with ThreadPoolExecutor(max_workers=len(datasets)) as executor:
+        list(executor.map(lambda item: dump_json(item[1], item[0]), datasets.items()))
 
-    return os.path.join(output_dir, "train/_annotations.coco.json")
+    return datasets[os.path.join(output_dir, "train/_annotations.coco.json")]
 
-def modify_coco_2_odvg(categories, video_id):
+def odvg_cache_key(categories, video_id, train_file):
+    """Hash of everything the ODVG conversion reads: the categories, the video and the
+    train split's annotations (so relabelled boxes also invalidate it)"""
+    h = hashlib.blake2b(json.dumps(categories, sort_keys=True).encode() + video_id.encode())
+    with open(train_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def modify_coco_2_odvg(categories, video_id, train_split=None):
+    """Write the video's train.jsonl and label.json. train_split is the dict returned by
+    split_dataset; without it the train annotations are read back from disk."""
     print("DEBUG: Categories received:", categories)
-    fp = os.path.join(GROUNDING_DINO_PATH, "GroundingDINO/tools/coco2odvg.py")
     input_path = os.path.join(GROUNDING_DINO_PATH, "GroundingDINO/input_params")
     TRAIN_FILE = os.path.join("data/grounding_dino_training/", video_id, "train/_annotations.coco.json")
+    video_dir = os.path.join(TRAINING_DIR, video_id)
+    odvg_file = os.path.join(video_dir, "train.jsonl")
+    label_filepath = os.path.join(video_dir, "label.json")
+    hash_path = os.path.join(video_dir, ODVG_HASH_FILE)
     
     # Write odvg
     write_datasets_mixed_odvg(video_id)
 
+    key = odvg_cache_key(categories, video_id, TRAIN_FILE)
+    try:
+        with open(hash_path, 'r') as f:
+            cached = f.read().strip() == key
+    except FileNotFoundError:
+        cached = False
+    if cached and os.path.exists(odvg_file) and os.path.exists(label_filepath):
+        print(f"ODVG files for {video_id} are up to date, skipping conversion")
+        return
+
     for i, cat in enumerate(categories):
         print(f"DEBUG: Processing category {i}: {cat}")
         
@@ -158,25 +403,24 @@ def modify_coco_2_odvg(categories, video_id):
         new_ori_map[str(cat["id"]-1)] = cat["name"]
         print(f"DEBUG: Added to maps: id-1={cat['id']-1}, id={cat['id']}, name={cat['name']}")
     
-    with open(fp, 'r') as file:
-        content = file.read()
-
-    content = re.sub(r'id_map\s*=\s*\{[^\}]*\}', f'id_map = {new_id_map}', content)
-    content = re.sub(r'ori_map\s*=\s*\{[^\}]*\}', f'ori_map = {new_ori_map}', content)
-    with open(fp, 'w') as file:
-        file.write(content)
-
     os.makedirs(input_path, exist_ok=True)
-    coco2odvg(TRAIN_FILE, os.path.join(f"data/grounding_dino_training/{video_id}/train.jsonl"))
+    if train_split is not None:
+        coco2odvg_from_objs(train_split["images"], train_split["annotations"],
+                            train_split["categories"], odvg_file, id_map=new_id_map)
+    else:
+        coco2odvg(TRAIN_FILE, odvg_file, id_map=new_id_map)
+
+    dump_json(new_ori_map, label_filepath)
 
-    label_filepath = os.path.join(f"data/grounding_dino_training/{video_id}/label.json")
-    with open(label_filepath, 'w') as label_file:
-        json.dump(new_ori_map, label_file)
+    # Written last, so an interrupted conversion is redone next time
+    with open(hash_path, 'w') as f:
+        f.write(key)
 
 
-def modify_config_files(categories):
+def modify_config_files(categories, video_id):
     """
-    Modify GroundingDINO config files with custom category labels
+    Write the video's GroundingDINO config files with its category labels. The templates
+    under GroundingDINO/config are left untouched, so jobs for different videos don't clash.
     """
     # Extract label names from categories
     labels = [cat["name"] for cat in categories]
@@ -185,42 +429,20 @@ def modify_config_files(categories):
     # Get paths to config files
     g_coco_path = os.path.join(GROUNDING_DINO_PATH, "GroundingDINO/config/cfg_coco.py")
     g_odvg_path = os.path.join(GROUNDING_DINO_PATH, "GroundingDINO/config/cfg_odvg.py")
+    video_dir = os.path.join(TRAINING_DIR, video_id)
 
     for fp in [g_coco_path, g_odvg_path]:
+        out_path = os.path.join(video_dir, os.path.basename(fp))
         try:
             with open(fp, 'r') as file:
-                content = file.readlines()
+                content = file.read()
 
-            # Create new content list
-            new_content = []
-            label_list_added = False
+            content = _LABEL_LIST_RE.sub('', content)
+            # A function replacement keeps backslashes in label names literal
+            content = _USE_COCO_EVAL_RE.sub(lambda m: 'use_coco_eval = False\n\n' + label_list_content, content)
 
-            i = 0
-            while i < len(content):
-                line = content[i]
-                
-                # Handle use_coco_eval line
-                if 'use_coco_eval' in line:
-                    new_content.append('use_coco_eval = False\n')
-                    new_content.append('\n')
-                    new_content.append(label_list_content)  # Add our custom label list
-                    label_list_added = True
-                    i += 1
-                    continue
-                
-                # Skip existing label_list lines and the list that follows
-                if 'label_list' in line:
-                    i += 2  # Skip this line and the next (the actual list)
-                    continue
-                
-                # Add other lines normally
-                if not (label_list_added and line.strip() == ''):  # Avoid duplicate blank lines
-                    new_content.append(line)
-                i += 1
-
-            # Write the modified content back to file
-            with open(fp, 'w') as file:
-                file.writelines(new_content)
+            with open(out_path, 'w') as file:
+                file.write(content)
                 
         except Exception as e:
             print(f"Error modifying config file {fp}: {str(e)}")
@@ -247,8 +469,4 @@ def write_datasets_mixed_odvg(video_id):
         ]
     }
     
-    DATASET_PATH = os.path.join(GROUNDING_DINO_PATH, "GroundingDINO", 'config', "datasets_mixed_odvg.json")
-    
-    with open(DATASET_PATH, 'w') as f:
-        import json
-        json.dump(dataset_config, f, indent=4)  # Added indent for better readability
\ No newline at end of file
+    dump_json(dataset_config, TRAINING_DATASETS_TPL.format(video_id), indent=4)  # Indented for readability
\ No newline at end of file
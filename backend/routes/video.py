@@ -1,7 +1,12 @@
+import io
 import os
 import subprocess
-from flask import Blueprint, request, jsonify, send_from_directory
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from flask import Blueprint, request, jsonify
 from werkzeug.utils import secure_filename
+from routes.util import cached_by_stat, send_data_file
 
 video_router = Blueprint("video", __name__)
 
@@ -9,37 +14,144 @@ video_router = Blueprint("video", __name__)
 BASE_DIR = "data"
 RAW_FRAMES_DIR = os.path.join(BASE_DIR, "raw_frames")
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
+ANNOTATIONS_DIR = os.path.join(BASE_DIR, "annotations")
+ANNOTATIONS_SUFFIX = "_coco_annotations.json"
+
+# Background frame extraction: ffmpeg does the work, so threads are enough to wait on it
+EXTRACTION_WORKERS = 2
+_extraction_pool = ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS)
+_extractions = {}  # video_id -> Future of a running extraction, or the error of a failed one
+_extractions_lock = threading.Lock()
+
+# Copy buffer for uploads Werkzeug kept in memory (its default is 16 KiB)
+UPLOAD_BUFFER_SIZE = 1 << 20
 
 # create necessary directories
 for directory in [BASE_DIR, RAW_FRAMES_DIR, UPLOAD_FOLDER]:
     os.makedirs(directory, exist_ok=True)
 
+def has_entries(path):
+    """True if path is a directory with at least one entry, without listing all of it"""
+    try:
+        with os.scandir(path) as entries:
+            return any(True for _ in entries)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+@lru_cache(maxsize=None)
+def cuda_frame_extraction_available():
+    """True if ffmpeg can decode on NVDEC and scale with scale_cuda (checked once)"""
+    try:
+        hwaccels = subprocess.run(["ffmpeg", "-hide_banner", "-hwaccels"], capture_output=True, text=True, check=True).stdout
+        filters = subprocess.run(["ffmpeg", "-hide_banner", "-filters"], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return "cuda" in hwaccels.split() and "scale_cuda" in filters
+
+@cached_by_stat()
+def listdir_sorted(path):
+    """Sorted directory listing, re-read only when the directory changes"""
+    return sorted(os.listdir(path))
+
+def save_upload(file, path):
+    """Save an uploaded file. Werkzeug spools large uploads to a temporary file; those are
+    copied with os.sendfile so the bytes never pass through Python."""
+    stream = file.stream
+    try:
+        src_fd = stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        file.save(path, buffer_size=UPLOAD_BUFFER_SIZE)
+        return
+    stream.flush()
+
+    size = os.fstat(src_fd).st_size
+    with open(path, 'wb') as dst:
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(dst.fileno(), src_fd, offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+
+def list_annotated_video_ids():
+    """Ids of all videos with a COCO annotations file, from a single directory scan"""
+    try:
+        with os.scandir(ANNOTATIONS_DIR) as entries:
+            return {entry.name[:-len(ANNOTATIONS_SUFFIX)] for entry in entries
+                    if entry.name.endswith(ANNOTATIONS_SUFFIX)}
+    except FileNotFoundError:
+        return set()
+
 def extract_frames(video_path, video_id):
     # extracts and resizes frames to 1280x720 from uploaded video
     frames_dir = os.path.join(RAW_FRAMES_DIR, video_id)
     os.makedirs(frames_dir, exist_ok=True)
     
     output_frames = os.path.join(frames_dir, "%04d.jpg")
+    if cuda_frame_extraction_available():
+        # Decode on NVDEC and scale on the GPU; only the scaled frames come back for JPEG encoding
+        ffmpeg_cmd = [
+            "ffmpeg", "-hwaccel", "cuda", "-hwaccel_output_format", "cuda",
+            "-i", video_path,
+            "-vf", "scale_cuda=1280:720,hwdownload,format=nv12",
+            "-q:v", "3",
+            output_frames
+        ]
+        try:
+            subprocess.run(ffmpeg_cmd, check=True)
+            return frames_dir
+        except subprocess.CalledProcessError as e:
+            print(f"Hardware frame extraction failed, retrying in software: {e}")
+
     ffmpeg_cmd = [
-        "ffmpeg", "-i", video_path,
+        "ffmpeg", "-threads", "0", "-i", video_path,
         "-vf", "scale=1280:720",
+        "-threads", "0", "-q:v", "3",
         output_frames
     ]
     subprocess.run(ffmpeg_cmd, check=True)
     return frames_dir
 
+def _extraction_error(future):
+    error = future.exception()
+    return f"Frame extraction failed: {error}" if error else None
+
+def _extraction_done(video_id, future):
+    """Drop a finished extraction's Future (and its traceback), keeping only a failure message"""
+    error = _extraction_error(future)
+    with _extractions_lock:
+        if _extractions.get(video_id) is not future:
+            return
+        if error:
+            _extractions[video_id] = error
+        else:
+            del _extractions[video_id]
+
+def get_extraction_state(video_id):
+    """(extracting, error) for a video's most recent background extraction"""
+    with _extractions_lock:
+        entry = _extractions.get(video_id)
+    if entry is None:
+        return False, None
+    if isinstance(entry, str):
+        return False, entry
+    if not entry.done():
+        return True, None
+    return False, _extraction_error(entry)
+
 @video_router.route("/uploaded-videos", methods=["GET"])
 def get_uploaded_videos():
     # lists all videos in the uploads directory
-    if not os.path.exists(UPLOAD_FOLDER):
+    try:
+        videos = listdir_sorted(UPLOAD_FOLDER)
+    except FileNotFoundError:
         return jsonify({"videos": []})
 
-    videos = sorted(os.listdir(UPLOAD_FOLDER))
     return jsonify({"videos": videos})
 
 @video_router.route("/upload", methods=["POST"])
 def upload_video():
-    # immediate frame extraction here
+    # saves the upload and starts frame extraction in the background
     if "video" not in request.files:
         return jsonify({"error": "No video file provided"}), 400
 
@@ -50,20 +162,25 @@ def upload_video():
     filename = secure_filename(file.filename)
     video_id = os.path.splitext(filename)[0]
     
+    extracting, _ = get_extraction_state(video_id)
+    if extracting:
+        return jsonify({"error": "Frames are still being extracted for this video"}), 409
+
     video_path = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(video_path)
+    save_upload(file, video_path)
     
-    try:
-        frames_dir = extract_frames(video_path, video_id)
-        frame_count = len(os.listdir(frames_dir))
-        
-        return jsonify({
-            "message": "Video uploaded and frames extracted successfully",
-            "filename": filename,
-            "frame_count": frame_count
-        })
-    except subprocess.CalledProcessError as e:
-        return jsonify({"error": f"Frame extraction failed: {str(e)}"}), 500
+    # Extract in the background; clients poll /check/<video_id> until "extracting" is false
+    with _extractions_lock:
+        future = _extractions[video_id] = _extraction_pool.submit(extract_frames, video_path, video_id)
+    # Added outside the lock: an already finished future runs the callback right here
+    future.add_done_callback(lambda f: _extraction_done(video_id, f))
+
+    return jsonify({
+        "message": "Video uploaded, extracting frames",
+        "status": "processing",
+        "filename": filename,
+        "video_id": video_id
+    }), 202
 
 @video_router.route("/frames/<video_id>", methods=["GET"])
 def get_video_frames(video_id):
@@ -72,10 +189,16 @@ def get_video_frames(video_id):
     # returns list of extracted frames for a video
     frames_dir = os.path.join(RAW_FRAMES_DIR, video_id)
     
-    if not os.path.exists(frames_dir):
+    extracting, _ = get_extraction_state(video_id)
+    if extracting:
+        # An empty frame list keeps callers that only check response.ok working
+        return jsonify({"status": "processing", "video_id": video_id, "frames": [], "frame_count": 0}), 202
+
+    try:
+        frames = listdir_sorted(frames_dir)
+    except FileNotFoundError:
         return jsonify({"error": "No frames found for this video"}), 404
 
-    frames = sorted(os.listdir(frames_dir))
     return jsonify({
         "video_id": video_id,
         "frames": frames,
@@ -91,20 +214,21 @@ def serve_frame(video_id, frame_filename):
     if not os.path.exists(os.path.join(frames_dir, frame_filename)):        
         return jsonify({"error": "Frame does not exist"}), 404
         
-    return send_from_directory(frames_dir, frame_filename)
+    return send_data_file(frames_dir, frame_filename)
 
 @video_router.route("/video/<filename>")
 def serve_video(filename):
     # Serves the original video file
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    return send_data_file(UPLOAD_FOLDER, filename)
 
 @video_router.route("/check/<video_id>", methods=["GET"])
 def check_video_readiness(video_id):
     """Check if video frames and annotations are available"""
     
-    # Check for frames
+    # Check for frames; a partially extracted folder doesn't count
+    extracting, extraction_error = get_extraction_state(video_id)
     frames_path = os.path.join("data", "raw_frames", video_id)
-    has_frames = os.path.exists(frames_path) and len(os.listdir(frames_path)) > 0
+    has_frames = not extracting and has_entries(frames_path)
     
     # Check for annotations
     annotations_path = os.path.join("data", "annotations", f"{video_id}_coco_annotations.json")
@@ -112,7 +236,11 @@ def check_video_readiness(video_id):
     
     # Prepare message
     message = []
-    if not has_frames:
+    if extracting:
+        message.append("Extracting video frames")
+    elif extraction_error:
+        message.append(extraction_error)
+    elif not has_frames:
         message.append("Video frames not found")
     if not has_annotations:
         message.append("Annotations not found")
@@ -120,6 +248,8 @@ def check_video_readiness(video_id):
     return jsonify({
         "frames": has_frames,
         "annotations": has_annotations,
+        "extracting": extracting,
+        "extraction_error": extraction_error,
         "message": ". ".join(message) if message else "Ready for training"
     })
     
@@ -127,9 +257,10 @@ def check_video_readiness(video_id):
 def check_inference_readiness(video_id):
     """Check if video frames and annotations are available"""
     
-    # Check for frames
+    # Check for frames; a partially extracted folder doesn't count
+    extracting, _ = get_extraction_state(video_id)
     frames_path = os.path.join("data", "raw_frames", video_id)
-    has_frames = os.path.exists(frames_path) and len(os.listdir(frames_path)) > 0
+    has_frames = not extracting and has_entries(frames_path)
     
     # Check for annotations
     annotations_path = os.path.join("data", "annotations", f"{video_id}_coco_annotations.json")
@@ -137,11 +268,13 @@ def check_inference_readiness(video_id):
     
     # Check for predictions
     predictions_path = os.path.join("data", "grounding_frames", video_id)
-    has_predictions = os.path.exists(predictions_path) and len(os.listdir(predictions_path)) > 0
+    has_predictions = has_entries(predictions_path)
     
     # Prepare message
     message = []
-    if not has_frames:
+    if extracting:
+        message.append("Extracting video frames")
+    elif not has_frames:
         message.append("Video frames not found")
     if not has_annotations:
         message.append("Annotations not found")
@@ -164,24 +297,28 @@ def list_videos():
         if not os.path.exists(raw_frames_path):
             return jsonify([])
             
-        video_ids = [d for d in os.listdir(raw_frames_path) 
-                    if os.path.isdir(os.path.join(raw_frames_path, d))]
+        with os.scandir(raw_frames_path) as entries:
+            video_dirs = [entry for entry in entries if entry.is_dir()]
+
+        # List uploads and annotations once instead of once per video
+        uploads_by_id = {}
+        for f in os.listdir(UPLOAD_FOLDER):
+            uploads_by_id.setdefault(os.path.splitext(f)[0], f)
+        annotated_ids = list_annotated_video_ids()
         
         # Check each video's status
         videos_info = []
-        for video_id in video_ids:
+        for entry in video_dirs:
+            video_id = entry.name
+
             # Check frames
-            frames_path = os.path.join(raw_frames_path, video_id)
-            has_frames = len(os.listdir(frames_path)) > 0 if os.path.exists(frames_path) else False
+            has_frames = has_entries(entry.path)
             
             # Check annotations
-            annotations_path = os.path.join("data", "annotations", f"{video_id}_coco_annotations.json")
-            has_annotations = os.path.exists(annotations_path)
+            has_annotations = video_id in annotated_ids
             
             # Get original video name from uploads folder (if available)
-            video_filename = next((f for f in os.listdir(UPLOAD_FOLDER) 
-                                if os.path.splitext(f)[0] == video_id), 
-                                f"{video_id}.mp4")
+            video_filename = uploads_by_id.get(video_id, f"{video_id}.mp4")
             
             videos_info.append({
                 "id": video_id,
@@ -0,0 +1,12 @@
+"""Production entry point.
+
+Training/inference status and the loaded models live in process memory, so run a
+single worker and scale with threads; status polling then never waits behind a
+long request:
+
+    gunicorn -w 1 -k gthread --threads 32 -b 0.0.0.0:5000 wsgi:app
+"""
+from app import app
+
+if __name__ == "__main__":
+    app.run(threaded=True)
@@ -8,6 +8,7 @@ export interface BoundingBox {
   height: number;
   label: string;
   category_id: number;
+  id?: number;
 }
 
 interface Category {
@@ -32,6 +33,7 @@ const BoundingBoxAnnotator: React.FC<BoundingBoxAnnotatorProps> = ({
   onSaveComplete
 }) => {
   const [boundingBoxes, setBoundingBoxes] = useState<BoundingBox[]>([]);
+  const [removedIds, setRemovedIds] = useState<number[]>([]);
   const [isDrawing, setIsDrawing] = useState(false);
   const [startPos, setStartPos] = useState<{ x: number; y: number } | null>(null);
   const [currentBox, setCurrentBox] = useState<BoundingBox | null>(null);
@@ -75,6 +77,7 @@ const BoundingBoxAnnotator: React.FC<BoundingBoxAnnotatorProps> = ({
         
         // Load boxes for this specific frame
         if (frameId) {
+          setRemovedIds([]);
           const boxesResponse = await fetch(`http://localhost:5000/api/annotation/get-frame/${videoId}/${frameId}`);
           if (boxesResponse.ok) {
             const data = await boxesResponse.json();
@@ -85,6 +88,7 @@ const BoundingBoxAnnotator: React.FC<BoundingBoxAnnotatorProps> = ({
                 width: ann.bbox[2],
                 height: ann.bbox[3],
                 category_id: ann.category_id,
+                id: ann.id,
                 label: categories.find(c => c.id === ann.category_id)?.name || `Player ${ann.category_id}`
               }));
               setBoundingBoxes(boxes);
@@ -244,31 +248,32 @@ const BoundingBoxAnnotator: React.FC<BoundingBoxAnnotatorProps> = ({
   
   // Save annotations for the current frame
   const handleSaveAnnotations = async () => {
-    if (!videoId || !frameId || boundingBoxes.length === 0) {
-      showToast("No annotations to save", "warning");
+    // Only boxes drawn since the last save are new; saved boxes carry their annotation id
+    const newBoxes = boundingBoxes.filter(box => box.id === undefined);
+    if (!videoId || !frameId || (newBoxes.length === 0 && removedIds.length === 0)) {
+      showToast("No changes to save", "warning");
       return;
     }
     
     try {
       setIsSaving(true);
       
-      // Convert boxes to COCO annotation format
-      const annotations = boundingBoxes.map((box, index) => ({
-        id: index + 1,
-        image_id: frameId,
+      // Convert new boxes to COCO annotation format; the server assigns ids and image_id
+      const added = newBoxes.map(box => ({
         category_id: box.category_id,
         bbox: [box.x, box.y, box.width, box.height],
         area: box.width * box.height,
         iscrowd: 0
       }));
       
-      const response = await fetch(`http://localhost:5000/api/annotation/save-frame`, {
+      const response = await fetch(`http://localhost:5000/api/annotation/save-frame-delta`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({
           video_id: videoId,
           frame_id: frameId,
-          annotations: annotations,
+          added: added,
+          removed: removedIds,
           width: imageSize.width,
           height: imageSize.height
         })
@@ -278,6 +283,15 @@ const BoundingBoxAnnotator: React.FC<BoundingBoxAnnotatorProps> = ({
         throw new Error("Failed to save annotations");
       }
       
+      // Record the ids the server gave the new boxes so later deletes can reference them
+      const result = await response.json();
+      const addedIds: number[] = result.added_ids || [];
+      let next = 0;
+      setBoundingBoxes(prev => prev.map(box =>
+        box.id === undefined && next < addedIds.length ? { ...box, id: addedIds[next++] } : box
+      ));
+      setRemovedIds([]);
+      
       showToast("Annotations saved successfully", "success");
       setIsAnnotating(false);
       if (onSaveComplete) onSaveComplete();
@@ -292,6 +306,10 @@ const BoundingBoxAnnotator: React.FC<BoundingBoxAnnotatorProps> = ({
   
   // Delete a specific box
   const handleDeleteBox = (index: number) => {
+    const removedId = boundingBoxes[index]?.id;
+    if (removedId !== undefined) {
+      setRemovedIds(prev => [...prev, removedId]);
+    }
     setBoundingBoxes(prev => prev.filter((_, i) => i !== index));
   };
   
@@ -370,7 +388,7 @@ const BoundingBoxAnnotator: React.FC<BoundingBoxAnnotatorProps> = ({
               <button 
                 className="btn btn-success"
                 onClick={handleSaveAnnotations}
-                disabled={isSaving || boundingBoxes.length === 0}
+                disabled={isSaving || (boundingBoxes.length === 0 && removedIds.length === 0)}
               >
                 {isSaving ? (
                   <>
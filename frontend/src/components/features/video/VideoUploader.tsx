@@ -11,6 +11,7 @@ const VideoUploader: React.FC<VideoUploaderProps> = ({ onSelectVideo, onUploadSu
   const [selectedFile, setSelectedFile] = useState<File | null>(null);
   const [uploading, setUploading] = useState(false);
   const [uploadProgress, setUploadProgress] = useState(0);
+  const [extracting, setExtracting] = useState(false);
   const [error, setError] = useState<string | null>(null);
   
   // Use our custom hook for managing uploaded videos
@@ -45,6 +46,23 @@ const VideoUploader: React.FC<VideoUploaderProps> = ({ onSelectVideo, onUploadSu
     event.preventDefault();
   };
   
+  // Poll until background frame extraction finishes; resolves to an error message on failure
+  const waitForFrameExtraction = async (videoId: string): Promise<string | null> => {
+    while (true) {
+      await new Promise((resolve) => setTimeout(resolve, 2000));
+      try {
+        const response = await fetch(`${backendUrl}/api/video/check/${videoId}`);
+        const data = await response.json();
+        if (!data.extracting) {
+          return data.extraction_error || null;
+        }
+      } catch (err) {
+        console.error(err);
+        return "Lost connection while extracting frames.";
+      }
+    }
+  };
+
   // Handle video upload
   const handleUpload = async () => {
     if (!selectedFile) {
@@ -72,9 +90,20 @@ const VideoUploader: React.FC<VideoUploaderProps> = ({ onSelectVideo, onUploadSu
       
       xhr.open('POST', `${backendUrl}/api/video/upload`);
       
-      xhr.onload = function() {
-        if (xhr.status === 200) {
+      xhr.onload = async function() {
+        if (xhr.status === 200 || xhr.status === 202) {
           const response = JSON.parse(xhr.responseText);
+          // 202: frames are extracted in the background, wait for them before opening the video
+          if (xhr.status === 202) {
+            setExtracting(true);
+            const extractionError = await waitForFrameExtraction(response.video_id);
+            setExtracting(false);
+            if (extractionError) {
+              setError(extractionError);
+              setUploading(false);
+              return;
+            }
+          }
           onUploadSuccess(response.filename);
           setSelectedFile(null);
           refreshVideos(); // Refresh the video list
@@ -218,7 +247,7 @@ const VideoUploader: React.FC<VideoUploaderProps> = ({ onSelectVideo, onUploadSu
           {uploading && (
             <div className="mt-4">
               <div className="flex justify-between mb-1">
-                <span>Uploading...</span>
+                <span>{extracting ? "Extracting frames..." : "Uploading..."}</span>
                 <span>{uploadProgress}%</span>
               </div>
               <progress 